@@ -8,7 +8,6 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import sys
-import json
 from urllib.parse import quote_plus, urlencode
 from authlib.integrations.flask_client import OAuth
 from flask import Flask, render_template, request, redirect, url_for, jsonify, abort, session
@@ -18,9 +17,25 @@ from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 
 from model import db, create_tables, Movie, Actor, Cast
-from model import queryCastByActor, queryMovieByActor
 
 from auth import AuthError, requires_auth
+from sessions import init_sessions, user_context
+from compression import init_compression
+from ratelimit import init_ratelimit
+from jobs import init_jobs, jobs_enabled, enqueue, accepted, run_inline
+from events import init_events, publish
+from snapshot import init_snapshot, current_snapshot
+from querystats import init_querystats
+from slowquery import init_slowquery
+from dedupe import init_dedupe, find_actor_duplicates, find_movie_duplicates, check_duplicates, merge_missing
+from dedupe import actor_to_dict, movie_to_dict
+from batch import init_batch
+from fieldsets import init_fieldsets, current_selection
+from sync import init_sync
+from profiling import init_profiling
+from replicas import init_replicas
+from coalesce import init_coalescing
+from repository import get_movie, get_actor, get_cast, find_cast, find_cast_role, count_movie_casts, count_actor_casts
 
 
 #----------------------------------------------------------------------------#
@@ -43,8 +58,23 @@ def create_app(test_config=None):
     print("applied db URL = ", app.config['SQLALCHEMY_DATABASE_URI'])
     
     CORS(app)
+    init_sessions(app)
+    init_compression(app)
+    init_ratelimit(app)
     db.init_app(app)
     migrate = Migrate(app, db)
+    init_replicas(app)
+    init_jobs(app)
+    init_events(app)
+    init_snapshot(app)
+    init_querystats(app)
+    init_slowquery(app)
+    init_dedupe(app)
+    init_batch(app)
+    init_fieldsets(app)
+    init_sync(app)
+    init_profiling(app)
+    init_coalescing(app)
 
     oauth = OAuth(app)
     oauth.register(
@@ -66,8 +96,10 @@ def create_app(test_config=None):
     @app.route("/callback", methods=["GET", "POST"])
     def callback():
         token = oauth.auth0.authorize_access_token()
+        session.clear()
+        # New session id for the logged in user
+        session.regenerate()
         session["user"] = token
-        print(token)
         return redirect("/")
 
     @app.route("/logout")
@@ -90,9 +122,14 @@ def create_app(test_config=None):
     @app.route('/')
     #@requires_auth('read:actors')
     def index():
-        movies = Movie.query.all()
-        actors = Actor.query.all()
-        return render_template('index.html', movies=movies, actors=actors, session=session.get('user'), pretty=json.dumps(session.get('user'), indent=4))
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            movies = snapshot.movies()
+            actors = snapshot.actors()
+        else:
+            movies = Movie.query.all()
+            actors = Actor.query.all()
+        return render_template('index.html', movies=movies, actors=actors, **user_context(session))
 
 
     #----------------------------------------------------------------------------#
@@ -107,6 +144,15 @@ def create_app(test_config=None):
         try:
             data = request.get_json()
             print("Received JSON data:", data)
+
+            # Bulk load: a list of movies is handed off to a background job
+            if isinstance(data, list):
+                if not all(isinstance(item, dict) for item in data):
+                    return jsonify({"error": "Every movie in the list must be an object"}), 400
+                if jobs_enabled(app):
+                    return accepted(enqueue("bulk_create_movies", movies=data, owner=payload.get("sub")))
+                return jsonify({"success": True, "data": run_inline("bulk_create_movies", movies=data)}), 201
+
             mov_title = data.get('mov_title')
             mov_release = data.get('mov_release')
             mov_language = data.get('mov_language')
@@ -118,16 +164,38 @@ def create_app(test_config=None):
             if not mov_title or not mov_release:
                 return jsonify({"error": "Mandatory value for either movie title or release year is missing."}), 400
 
+            # Look for the same (or a very similar) title released in the same year
+            exact, near = find_movie_duplicates(mov_title, mov_release)
+            action, duplicate, warnings = check_duplicates(exact, near)
+            if action == "reject":
+                return jsonify({"error": "Duplicate entry. Movie already exists.", "duplicate": movie_to_dict(duplicate)}), 409
+            if action == "merge":
+                if merge_missing(duplicate, {'mov_language': mov_language}):
+                    db.session.commit()
+                body = {
+                    'mov_id': duplicate.mov_id,
+                    'mov_title': duplicate.mov_title,
+                    'mov_release': duplicate.mov_release,
+                    'mov_language': duplicate.mov_language
+                }
+                return jsonify({"success": True, "merged": True, "mov_title": duplicate.mov_title, "data": body}), 200
+            warnings = [dict(movie_to_dict(row), match=kind) for kind, row in warnings]
+
             movie = Movie(mov_title=mov_title, mov_release=mov_release, mov_language=mov_language)
             db.session.add(movie)
             db.session.commit()
 
             body = {
+                'mov_id': movie.mov_id,
                 'mov_title': movie.mov_title,
                 'mov_release': movie.mov_release,
                 'mov_language': movie.mov_language
             }
-            return jsonify({"success": True, "mov_title": movie.mov_title, "data": body}), 201
+            publish("movie.created", **body)
+            response_body = {"success": True, "mov_title": movie.mov_title, "data": body}
+            if warnings:
+                response_body["possible_duplicates"] = warnings
+            return jsonify(response_body), 201
 
         except Exception as err_mov_crt:
             db.session.rollback()
@@ -142,15 +210,20 @@ def create_app(test_config=None):
     @requires_auth('delete:movie')
     def delete_movie(payload, mov_id):
         try:
-            movie = Movie.query.get(mov_id)
+            movie = get_movie(mov_id)
 
             if movie:
+                # Hand large cascading deletes off to a background job
+                if jobs_enabled(app) and count_movie_casts(mov_id) >= app.config["JOBS_CASCADE_THRESHOLD"]:
+                    return accepted(enqueue("delete_movie", mov_id=mov_id, owner=payload.get("sub")))
+
                 # Delete associated cast entries
                 Cast.query.filter_by(mov_id=mov_id).delete()
 
                 # Now, delete the movie
                 db.session.delete(movie)
                 db.session.commit()
+                publish("movie.deleted", mov_id=mov_id)
                 return jsonify({'success': True})
             else:
                 return jsonify({'success': False, 'error': 'Movie not found in database'}), 404
@@ -169,12 +242,13 @@ def create_app(test_config=None):
             new_title = request.json.get('newTitle')
 
             # Fetch the movie record from the database using movie_id
-            movie = Movie.query.get(mov_id)
+            movie = get_movie(mov_id)
 
             if movie:
                 # Update the movie title
                 movie.mov_title = new_title
                 db.session.commit()
+                publish("movie.updated", mov_id=mov_id, mov_title=new_title)
                 return jsonify({"success": True})
             else:
                 return jsonify({"success": False, "error": "Movie not found"})
@@ -199,6 +273,15 @@ def create_app(test_config=None):
         body = {}
         try:
             data = request.get_json()
+
+            # Bulk load: a list of actors is handed off to a background job
+            if isinstance(data, list):
+                if not all(isinstance(item, dict) for item in data):
+                    return jsonify({"error": "Every actor in the list must be an object"}), 400
+                if jobs_enabled(app):
+                    return accepted(enqueue("bulk_create_actors", actors=data, owner=payload.get("sub")))
+                return jsonify({"success": True, "data": run_inline("bulk_create_actors", actors=data)}), 201
+
             act_firstname = data.get('act_firstname')
             act_lastname = data.get('act_lastname')
             act_language = data.get('act_language')
@@ -207,17 +290,40 @@ def create_app(test_config=None):
             if not act_firstname or not act_lastname:
                 return jsonify({"error": "Invalid request data in Actors"}), 400
 
+            # Look for actors with the same (or a very similar) name
+            exact, near = find_actor_duplicates(act_firstname, act_lastname)
+            action, duplicate, warnings = check_duplicates(exact, near)
+            if action == "reject":
+                return jsonify({"error": "Duplicate entry. Actor already exists.", "duplicate": actor_to_dict(duplicate)}), 409
+            if action == "merge":
+                if merge_missing(duplicate, {'act_language': act_language, 'act_gender': act_gender}):
+                    db.session.commit()
+                body = {
+                    'act_id': duplicate.act_id,
+                    'act_firstname': duplicate.act_firstname,
+                    'act_lastname': duplicate.act_lastname,
+                    'act_language': duplicate.act_language,
+                    'act_gender': duplicate.act_gender
+                }
+                return jsonify({"success": True, "merged": True, "act_firstname": duplicate.act_firstname, "data": body}), 200
+            warnings = [dict(actor_to_dict(row), match=kind) for kind, row in warnings]
+
             actor = Actor(act_firstname=act_firstname, act_lastname=act_lastname, act_language=act_language, act_gender=act_gender)
             db.session.add(actor)
             db.session.commit()
 
             body = {
+                'act_id': actor.act_id,
                 'act_firstname': actor.act_firstname,
                 'act_lastname': actor.act_lastname,
                 'act_language': actor.act_language,
                 'act_gender': actor.act_gender
             }
-            return jsonify({"success": True, "act_firstname": actor.act_firstname, "data": body}), 201
+            publish("actor.created", **body)
+            response_body = {"success": True, "act_firstname": actor.act_firstname, "data": body}
+            if warnings:
+                response_body["possible_duplicates"] = warnings
+            return jsonify(response_body), 201
 
         except Exception as err_act_crt:
             db.session.rollback()
@@ -231,16 +337,22 @@ def create_app(test_config=None):
     @app.route('/actor', methods=['GET'])
     @requires_auth('read:actors')
     def show_actor(payload):
-        actors = Actor.query.all()
-        return render_template('portfolio.html', actors=actors, session=session.get('user'), pretty=json.dumps(session.get('user'), indent=4))
+        snapshot = current_snapshot()
+        actors = snapshot.actors() if snapshot is not None else Actor.query.all()
+        return render_template('portfolio.html', actors=actors, **user_context(session))
 
     @app.route('/actor/<int:act_id>/movies')
     def get_actor_portfolio(act_id):
+        # Only the columns of ?fields= and ?include= are selected
+        fieldset, selection = current_selection()
+        try:
+            result = fieldset.load(act_id, selection)
+        except SQLAlchemyError as act_retrieve_error:
+            print(str(act_retrieve_error))
+            result = None
 
-        movies = queryMovieByActor(act_id)
-
-        if movies is not None:
-            return jsonify(success=True, cast_list=movies)
+        if result is not None:
+            return fieldset.response(*result)
         else:
             return jsonify(success=False, message='Failed to retrieve movies')
 
@@ -249,11 +361,16 @@ def create_app(test_config=None):
     @requires_auth('delete:actor')
     def delete_actor(payload, act_id):
         try:
-            actor = Actor.query.get(act_id)
+            actor = get_actor(act_id)
 
             if actor:
+                # Hand large cascading deletes off to a background job
+                if jobs_enabled(app) and count_actor_casts(act_id) >= app.config["JOBS_CASCADE_THRESHOLD"]:
+                    return accepted(enqueue("delete_actor", act_id=act_id, owner=payload.get("sub")))
+
                 db.session.delete(actor)
                 db.session.commit()
+                publish("actor.deleted", act_id=act_id)
                 return jsonify({'success': True})
             else:
                 return jsonify({'success': False, 'error': 'Actor not found'}), 404
@@ -276,8 +393,9 @@ def create_app(test_config=None):
     @requires_auth('read:cast')
     def show_cast(payload):
 
-        movies = Movie.query.all()
-        return render_template('cast.html', movies=movies, session=session.get('user'), pretty=json.dumps(session.get('user'), indent=4))
+        snapshot = current_snapshot()
+        movies = snapshot.movies() if snapshot is not None else Movie.query.all()
+        return render_template('cast.html', movies=movies, **user_context(session))
 
     # Endpoint to assign actors to movie casts.
     @app.route('/movie/<int:mov_id>/cast/add/<int:act_id>', methods=['POST'])
@@ -285,19 +403,21 @@ def create_app(test_config=None):
     def add_actor_to_cast(mov_id, act_id, cas_role):
         try:
             #print(f"Received mov_id: {mov_id}, act_id: {act_id}, cas_role: {cas_role}")
-            movie = Movie.query.get(mov_id)
-            actor = Actor.query.get(act_id)
-            role = Cast.query.get(cas_role)
+            movie = get_movie(mov_id)
+            actor = get_actor(act_id)
+            role = get_cast(cas_role)
 
             if movie and actor:
                 # Check if the combination of movie_id and actor_id already exists
-                existing_cast = Cast.query.filter_by(mov_id=mov_id, act_id=act_id).first()
+                existing_cast = find_cast(mov_id, act_id)
                 if existing_cast:
                     return jsonify({'success': False, 'error': "Actor is already in this movie's cast"}), 400
 
                 cast = Cast(movie=movie, actor=actor, role=role)
                 db.session.add(cast)
                 db.session.commit()
+                publish("cast.created", mov_id=mov_id, act_id=act_id, mov_title=movie.mov_title,
+                        act_firstname=actor.act_firstname, act_lastname=actor.act_lastname, cas_role=cast.cas_role)
                 return jsonify({'success': True})
             else:
                 return jsonify({'success': False, 'error': 'Movie or actor not found'}), 404
@@ -315,27 +435,15 @@ def create_app(test_config=None):
     @requires_auth('read:cast')
     def get_movie_cast(payload, mov_id):
         try:
-            movie = Movie.query.get(mov_id)
+            # Only the columns of ?fields= and ?include= are selected, in one query
+            fieldset, selection = current_selection()
+            result = fieldset.load(mov_id, selection)
 
             # Check if the movie exists
-            if not movie:
+            if result is None:
                 return jsonify({'success': False, 'error': 'Movie not found'}), 404
 
-            cast_list = []
-
-            for cast_entry in movie.casts:
-                cast_dict = {
-                    "act_id": cast_entry.actor.act_id,
-                    "act_firstname": cast_entry.actor.act_firstname,
-                    "act_lastname": cast_entry.actor.act_lastname,
-                }
-
-                if cast_entry.cas_role is not None:  # Access cas_role directly from cast_entry
-                    cast_dict["cas_role"] = cast_entry.cas_role
-
-                cast_list.append(cast_dict)
-
-            return jsonify({'success': True, 'cast_list': cast_list})
+            return fieldset.response(*result)
 
         except SQLAlchemyError as err_mov_cast:
             # Handle database errors
@@ -357,11 +465,16 @@ def create_app(test_config=None):
     @app.route('/actor/<int:act_id>/casts', methods=['GET'])
     @requires_auth('read:actor_portfolio')
     def get_actor_casts(payload, act_id):
+        # Only the columns of ?fields= and ?include= are selected
+        fieldset, selection = current_selection()
+        try:
+            result = fieldset.load(act_id, selection)
+        except SQLAlchemyError as act_retrieve_error:
+            print(str(act_retrieve_error))
+            result = None
 
-        casts = queryCastByActor(act_id)
-
-        if casts is not None:
-            return jsonify(success=True, cast_list=casts)
+        if result is not None:
+            return fieldset.response(*result)
         else:
             return jsonify(success=False, message='Failed to retrieve movies')
 
@@ -370,16 +483,18 @@ def create_app(test_config=None):
     @requires_auth('delete:actor')
     def delete_actor_from_cast(payload, mov_id, act_id):
         try:
-            movie = Movie.query.get(mov_id)
-            actor = Actor.query.get(act_id)
+            movie = get_movie(mov_id)
+            actor = get_actor(act_id)
 
             if movie and actor:
                 # Check if the combination of movie_id and actor_id exists in the cast list
-                cast_entry = Cast.query.filter_by(mov_id=mov_id, act_id=act_id).first()
+                cast_entry = find_cast(mov_id, act_id)
 
                 if cast_entry:
+                    cas_role = cast_entry.cas_role
                     db.session.delete(cast_entry)
                     db.session.commit()
+                    publish("cast.deleted", mov_id=mov_id, act_id=act_id, cas_role=cas_role)
                     return jsonify({'success': True, 'message': 'Actor removed from the cast list'}), 200
                 else:
                     return jsonify({'success': False, 'message': 'Actor not found in the cast list'}), 404
@@ -411,7 +526,7 @@ def create_app(test_config=None):
                 return jsonify({"error": "Please provide all required information."}), 400
 
             # Check if the combination already exists in the 'casts' table
-            existing_cast = Cast.query.filter_by(mov_id=mov_id, act_id=act_id, cas_role=cas_role).first()
+            existing_cast = find_cast_role(mov_id, act_id, cas_role)
 
             if existing_cast:
                 return jsonify({"error": "Duplicate entry. Cast already exists."}), 409
@@ -419,6 +534,8 @@ def create_app(test_config=None):
             cast = Cast(mov_id=mov_id, act_id=act_id, cas_role=cas_role)
             db.session.add(cast)
             db.session.commit()
+            publish("cast.created", mov_id=cast.mov_id, act_id=cast.act_id, mov_title=cast.movie.mov_title,
+                    act_firstname=cast.actor.act_firstname, act_lastname=cast.actor.act_lastname, cas_role=cast.cas_role)
 
             # Return the created cast data in the response
             response_body = {
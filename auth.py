@@ -7,7 +7,9 @@ import os
 
 from jose import jwt
 
-from flask import request
+from flask import current_app, request
+
+from ratelimit import shed_load, check_rate_limit
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -155,13 +157,42 @@ def verify_decode_jwt(token):
         }, 400)
 
 
+# Environ key of the token payload verified by a batch request (see batch.py),
+# set on its sub-requests only, clients can't send it in a header
+BATCH_PAYLOAD = "casting_agency.batch_payload"
+
+
+def verify_request_token():
+    """
+    Verifies the bearer token of the request, returns the decoded payload
+    """
+    shed_load()
+    token = get_token_auth_header()
+    return verify_decode_jwt(token)
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            # Sub-requests of a batch reuse the token the batch verified
+            payload = request.environ.get(BATCH_PAYLOAD)
+            if payload is None:
+                payload = verify_request_token()
             check_permissions(permission, payload)
+            check_rate_limit(permission, payload)
+            # Run under the profiler when asked to (see profiling.py)
+            profiler = current_app.extensions.get("profiler")
+            if profiler is not None:
+                trigger = profiler.trigger(payload)
+                if trigger is not None:
+                    return profiler.run(trigger, f, payload, *args, **kwargs)
+            # Share the response of an identical read in progress (see coalesce.py)
+            coalescer = current_app.extensions.get("coalescer")
+            if coalescer is not None:
+                key = coalescer.key(payload)
+                if key is not None:
+                    return coalescer.run(key, f, payload, *args, **kwargs)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,157 @@
+from flask import g, jsonify, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+
+from auth import BATCH_PAYLOAD, verify_request_token
+from events import publish_pending
+from model import db
+
+# Batch requests
+# POST /batch runs an ordered list of sub-requests against the other API
+# routes and verifies the bearer token only once. Each sub-request still
+# checks its own permission against the scopes of that token. With
+# "transaction": true all sub-requests share one database transaction, which
+# is committed when every sub-request succeeded and rolled back otherwise.
+
+# Routes which can't run inside a batch
+EXCLUDED_ENDPOINTS = {"batch", "event_stream", "login", "callback", "logout", "static"}
+
+# Response headers passed on to the client
+FORWARDED_HEADERS = ("Location", "Retry-After")
+
+
+class BatchSession(Session):
+    """
+    Session of a transactional batch. Commits of the handlers only flush and
+    closing keeps the transaction open, a rollback fails the whole batch.
+    """
+
+    rolled_back = False
+
+    def commit(self):
+        self.flush()
+
+    def close(self):
+        pass
+
+    def rollback(self):
+        self.rolled_back = True
+        super().rollback()
+
+    def commit_batch(self):
+        super().commit()
+
+    def close_batch(self):
+        super().close()
+
+
+def error_result(status, message):
+    return {"status": status, "body": {"success": False, "error": status, "message": message}}
+
+
+def run_subrequest(app, payload, item):
+    """
+    Dispatches one sub-request, returns its status, headers and body
+    """
+    if not isinstance(item, dict) or not isinstance(item.get("path"), str) or not item["path"].startswith("/"):
+        return error_result(400, "Sub-request needs a path")
+    method = str(item.get("method", "GET")).upper()
+    path = item["path"]
+
+    try:
+        endpoint, _ = app.url_map.bind("localhost").match(path.split("?", 1)[0], method=method)
+    except HTTPException as err_match:
+        return error_result(err_match.code, err_match.description)
+    if endpoint in EXCLUDED_ENDPOINTS:
+        return error_result(400, f"{path} can't be part of a batch")
+
+    options = {"method": method, "environ_base": {BATCH_PAYLOAD: payload}}
+    if "body" in item:
+        options["json"] = item["body"]
+    elif "form" in item:
+        options["data"] = item["form"]
+
+    # The sub-requests share the app context (and the database session) of
+    # the batch, keep their request globals apart
+    saved_globals = vars(g).copy()
+    try:
+        with app.test_request_context(path, **options):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as err_batch:
+                print(f"Batch sub-request {method} {path} failed:", str(err_batch))
+                return error_result(500, "Internal server error")
+    finally:
+        vars(g).clear()
+        vars(g).update(saved_globals)
+
+    result = {"status": response.status_code}
+    headers = {name: response.headers[name] for name in FORWARDED_HEADERS if name in response.headers}
+    if headers:
+        result["headers"] = headers
+    body = response.get_json(silent=True)
+    result["body"] = body if body is not None else response.get_data(as_text=True)
+    return result
+
+
+def run_transaction(app, payload, items):
+    """
+    Runs the sub-requests in one transaction, stops at the first failure.
+    Returns (committed, responses).
+    """
+    db.session.remove()
+    session = BatchSession(**db.session.session_factory.kw)
+    db.session.registry.set(session)
+    g.pending_events = []
+
+    responses = []
+    committed = False
+    try:
+        for item in items:
+            result = run_subrequest(app, payload, item)
+            responses.append(result)
+            if result["status"] >= 400 or session.rolled_back:
+                break
+        else:
+            session.commit_batch()
+            committed = True
+    except SQLAlchemyError as err_commit:
+        print(str(err_commit))
+        responses.append(error_result(500, "Database error"))
+    finally:
+        if not committed:
+            session.rollback()
+        session.close_batch()
+        events = g.pop("pending_events")
+        db.session.remove()
+
+    if committed:
+        publish_pending(events)
+    return committed, responses
+
+
+def init_batch(app):
+    app.config.setdefault("BATCH_ENABLED", False)
+    app.config.setdefault("BATCH_MAX_REQUESTS", 50)
+    if not app.config["BATCH_ENABLED"]:
+        return
+
+    # Run several API requests with one token check, see the README for the format
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        payload = verify_request_token()
+
+        data = request.get_json(silent=True)
+        items = data.get("requests") if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({"success": False, "error": "Expected a list of requests"}), 400
+        if len(items) > app.config["BATCH_MAX_REQUESTS"]:
+            return jsonify({"success": False, "error": f"At most {app.config['BATCH_MAX_REQUESTS']} requests per batch"}), 400
+
+        if not data.get("transaction"):
+            responses = [run_subrequest(app, payload, item) for item in items]
+            return jsonify({"success": True, "responses": responses})
+
+        committed, responses = run_transaction(app, payload, items)
+        return jsonify({"success": committed, "committed": committed, "responses": responses})
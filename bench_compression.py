@@ -0,0 +1,78 @@
+"""
+Benchmark of the CPU versus bytes tradeoff of response compression.
+
+Renders the real templates (index.html, cast.html, portfolio.html) and a
+cast JSON response with a generated catalog, and compresses them at
+different gzip and brotli levels.
+
+Usage: python bench_compression.py [number_of_movies] [number_of_actors]
+"""
+import gzip
+import json
+import sys
+import time
+from types import SimpleNamespace
+
+from jinja2 import Environment, FileSystemLoader
+
+from compression import brotli
+
+
+def build_catalog(n_movies, n_actors):
+    movies = [
+        SimpleNamespace(mov_id=i, mov_title=f"Movie title {i}", mov_release=1950 + i % 70, mov_language="EN")
+        for i in range(1, n_movies + 1)
+    ]
+    actors = [
+        SimpleNamespace(act_id=i, act_firstname=f"Firstname{i}", act_lastname=f"Lastname{i}", act_language="EN", act_gender="Female" if i % 2 else "Male")
+        for i in range(1, n_actors + 1)
+    ]
+    return movies, actors
+
+
+def render_pages(n_movies, n_actors):
+    movies, actors = build_catalog(n_movies, n_actors)
+    env = Environment(loader=FileSystemLoader("templates"), autoescape=True)
+    user = {"userinfo": {"nickname": "benchmark"}}
+    pretty = json.dumps(user, indent=4)
+    cast_list = [
+        {"act_id": a.act_id, "act_firstname": a.act_firstname, "act_lastname": a.act_lastname, "cas_role": f"Role {a.act_id}"}
+        for a in actors
+    ]
+    return {
+        "index.html": env.get_template("index.html").render(movies=movies, actors=actors, session=user, pretty=pretty).encode(),
+        "cast.html": env.get_template("cast.html").render(movies=movies, session=user, pretty=pretty).encode(),
+        "portfolio.html": env.get_template("portfolio.html").render(actors=actors, session=user, pretty=pretty).encode(),
+        "movie cast json": json.dumps({"success": True, "cast_list": cast_list}).encode(),
+    }
+
+
+def measure(compress, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        out = compress(data)
+    elapsed = (time.perf_counter() - start) / rounds
+    return len(out), elapsed
+
+
+def main():
+    n_movies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_actors = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rounds = 20
+
+    codecs = [(f"gzip-{level}", lambda d, level=level: gzip.compress(d, compresslevel=level)) for level in (1, 6, 9)]
+    if brotli is not None:
+        codecs += [(f"br-{q}", lambda d, q=q: brotli.compress(d, quality=q)) for q in (1, 4, 6, 11)]
+    else:
+        print("brotli not installed, only measuring gzip")
+
+    for name, data in render_pages(n_movies, n_actors).items():
+        print(f"\n{name}: {len(data)} bytes")
+        print(f"{'codec':<10}{'bytes':>10}{'ratio':>9}{'ms':>10}{'MB/s':>9}")
+        for codec, compress in codecs:
+            size, elapsed = measure(compress, data, rounds)
+            print(f"{codec:<10}{size:>10}{len(data) / size:>9.1f}{elapsed * 1000:>10.2f}{len(data) / elapsed / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
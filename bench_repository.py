@@ -0,0 +1,81 @@
+"""
+Benchmark of the per-call overhead of the handler lookups.
+
+Runs the legacy Query lookups the handlers used (Model.query.get,
+Cast.query.filter_by(...).first() and .count()) next to their replacements
+in repository.py against an in-memory SQLite catalog. "cold" clears the
+session before every call, like a new request; "warm" repeats the lookup
+in the same session, where session.get is answered by the identity map.
+
+Usage: python bench_repository.py [number_of_lookups]
+"""
+import sys
+import time
+import warnings
+
+from flask import Flask
+from sqlalchemy.exc import LegacyAPIWarning
+
+from model import db, Movie, Actor, Cast
+import repository
+
+N_MOVIES = 200
+N_ACTORS = 500
+
+
+def create_catalog():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(Movie(mov_title=f"Movie title {i}", mov_release=1950 + i % 70, mov_language="EN")
+                           for i in range(N_MOVIES))
+        db.session.add_all(Actor(act_firstname=f"Firstname{i}", act_lastname=f"Lastname{i}", act_language="EN")
+                           for i in range(N_ACTORS))
+        db.session.flush()
+        db.session.add_all(Cast(mov_id=1 + i % N_MOVIES, act_id=1 + i, cas_role=f"Role {i}")
+                           for i in range(N_ACTORS))
+        db.session.commit()
+    return app
+
+
+def measure(lookup, n, cold):
+    # The identity map only keeps rows which are still referenced
+    held = []
+    start = time.perf_counter()
+    for i in range(n):
+        if cold:
+            db.session.expunge_all()
+        held.append(lookup(1 + i % N_ACTORS))
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # Query.get is deprecated in SQLAlchemy 2.0
+    warnings.simplefilter("ignore", LegacyAPIWarning)
+    app = create_catalog()
+
+    lookups = [
+        ("actor by id", lambda i: Actor.query.get(i), repository.get_actor),
+        ("cast of actor in movie", lambda i: Cast.query.filter_by(mov_id=1 + (i - 1) % N_MOVIES, act_id=i).first(),
+         lambda i: repository.find_cast(1 + (i - 1) % N_MOVIES, i)),
+        ("count of movie cast", lambda i: Cast.query.filter_by(mov_id=1 + i % N_MOVIES).count(),
+         lambda i: repository.count_movie_casts(1 + i % N_MOVIES)),
+    ]
+
+    with app.app_context():
+        print(f"{'lookup':<24}{'session':>8}{'legacy us':>12}{'repository us':>15}{'speedup':>9}")
+        for name, legacy, current in lookups:
+            for cold in (True, False):
+                # First calls fill the statement caches
+                measure(legacy, 100, cold)
+                measure(current, 100, cold)
+                before = measure(legacy, n, cold)
+                after = measure(current, n, cold)
+                print(f"{name:<24}{'cold' if cold else 'warm':>8}{before * 1e6:>12.1f}{after * 1e6:>15.1f}{before / after:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import threading
+from collections import Counter
+
+from flask import Response, current_app, g, jsonify, request
+
+from auth import BATCH_PAYLOAD, requires_auth
+from replicas import reads_from_primary
+
+# Request coalescing
+# Identical read requests running at the same time in a worker share one
+# computation: the first one (the leader) runs the endpoint, the others wait
+# for its response instead of running the same queries. Requests are
+# identical when route, url arguments, query string, token scopes and read
+# source (primary or replica) match. A waiting request which times out runs
+# the endpoint itself.
+
+
+class Flight:
+    """
+    One computation in progress and the requests waiting for it
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+class Coalescer:
+    def __init__(self, routes, timeout=5):
+        self.routes = set(routes)
+        self.timeout = timeout
+        self.stats = Counter()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def report(self):
+        with self._lock:
+            return {"stats": dict(self.stats), "in_flight": len(self._flights)}
+
+    def key(self, payload):
+        """
+        Key of the current request, None when it must not be shared
+        """
+        if request.endpoint not in self.routes or request.method != "GET":
+            return None
+        # Batch requests may see uncommitted changes, recent writers must see their own
+        if request.environ.get(BATCH_PAYLOAD) is not None or reads_from_primary():
+            return None
+        return (
+            request.endpoint,
+            tuple(sorted((request.view_args or {}).items())),
+            tuple(sorted(request.args.items(multi=True))),
+            frozenset(payload.get("permissions", [])),
+            g.get("read_engine") is not None,
+        )
+
+    def run(self, key, f, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if leader:
+            self.count("leaders")
+            try:
+                response = current_app.make_response(f(*args, **kwargs))
+                if not response.is_streamed:
+                    flight.response = (response.get_data(), response.status_code, list(response.headers.items()))
+                return response
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        if not flight.done.wait(self.timeout):
+            self.count("timeouts")
+            return f(*args, **kwargs)
+        if flight.response is None:
+            # The leader failed, try on our own
+            self.count("failed_leaders")
+            return f(*args, **kwargs)
+
+        self.count("coalesced")
+        data, status, headers = flight.response
+        response = Response(data, status=status, headers=headers)
+        response.headers["X-Coalesced"] = "1"
+        return response
+
+
+def init_coalescing(app):
+    app.config.setdefault("COALESCE_ENABLED", False)
+    if not app.config["COALESCE_ENABLED"]:
+        return
+
+    coalescer = Coalescer(app.config.get("COALESCE_ROUTES", []), app.config.get("COALESCE_TIMEOUT", 5))
+    app.extensions["coalescer"] = coalescer
+
+    # Coalescing counters of this worker
+    @app.route('/stats/coalescing', methods=['GET'])
+    @requires_auth('read:movies')
+    def coalescing_stats(payload):
+        return jsonify(success=True, **coalescer.report())
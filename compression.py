@@ -0,0 +1,106 @@
+import gzip
+import zlib
+
+from flask import request
+
+# Optional brotli support, either package provides the same API
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# Response compression
+# Opt-in with COMPRESS_ENABLED, compresses HTML and JSON responses above
+# COMPRESS_MIN_SIZE bytes with brotli or gzip depending on Accept-Encoding.
+
+
+def compress_body(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compresses a streamed (generator) response chunk by chunk
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.process(chunk)
+            # Push out what we have so the client receives every chunk
+            data += compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def choose_encoding(app):
+    offered = ["gzip"]
+    if brotli is not None and app.config.get("COMPRESS_BROTLI", True):
+        offered.insert(0, "br")
+    return request.accept_encodings.best_match(offered)
+
+
+def should_compress(app, response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if "Content-Encoding" in response.headers:
+        return False
+    if response.mimetype not in app.config["COMPRESS_MIMETYPES"]:
+        return False
+    if request.method == "HEAD":
+        return False
+    return True
+
+
+def init_compression(app):
+    app.config.setdefault("COMPRESS_ENABLED", False)
+    app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+    app.config.setdefault("COMPRESS_BROTLI_LEVEL", 4)
+    app.config.setdefault("COMPRESS_MIMETYPES", ["text/html", "application/json"])
+
+    if not app.config["COMPRESS_ENABLED"]:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if not should_compress(app, response):
+            return response
+
+        encoding = choose_encoding(app)
+        if encoding is None:
+            return response
+
+        level = app.config["COMPRESS_BROTLI_LEVEL"] if encoding == "br" else app.config["COMPRESS_LEVEL"]
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop("Content-Length", None)
+        else:
+            if response.direct_passthrough:
+                return response
+            data = response.get_data()
+            if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+                return response
+            response.set_data(compress_body(data, encoding, level))
+
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
@@ -1,9 +1,13 @@
+import os
+import tempfile
 from os import environ as env
 from dotenv import load_dotenv
 load_dotenv()
 
 class Config:
     DEBUG = True
+    # Threads per gunicorn worker (see Procfile)
+    WEB_THREADS = int(env.get("WEB_THREADS", 8))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = env.get("APP_SECRET_KEY")
     AUTH0_CLIENT_ID = env.get("AUTH0_CLIENT_ID")
@@ -12,6 +16,127 @@ class Config:
     API_AUDIENCE = env.get("API_AUDIENCE")
     ALGORITHMS = env.get("ALGORITHMS")
 
+    # Server-side sessions: "memory", "sqlite" or "redis"
+    SESSION_STORE = env.get("SESSION_STORE", "sqlite")
+    SESSION_SQLITE_PATH = env.get("SESSION_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "casting_sessions.db"))
+    SESSION_REDIS_URL = env.get("SESSION_REDIS_URL")
+
+    # Response compression (gzip / brotli)
+    COMPRESS_ENABLED = env.get("COMPRESS_ENABLED", "false").lower() == "true"
+    COMPRESS_MIN_SIZE = int(env.get("COMPRESS_MIN_SIZE", 500))
+    COMPRESS_LEVEL = int(env.get("COMPRESS_LEVEL", 6))
+    COMPRESS_BROTLI_LEVEL = int(env.get("COMPRESS_BROTLI_LEVEL", 4))
+
+    # Rate limiting per token subject and permission: "memory" or "redis"
+    RATELIMIT_ENABLED = env.get("RATELIMIT_ENABLED", "true").lower() == "true"
+    RATELIMIT_STORE = env.get("RATELIMIT_STORE", "memory")
+    RATELIMIT_REDIS_URL = env.get("RATELIMIT_REDIS_URL")
+    RATELIMIT_DEFAULT = "120/minute"
+    # Budgets per endpoint or permission, "<requests>/<second|minute|hour>"
+    RATELIMIT_BUDGETS = {
+        "create_movie": "30/minute",
+        "create_actor": "30/minute",
+        "create_cast": "60/minute",
+        "delete_movie": "30/minute",
+        "delete_actor": "30/minute",
+        "delete_actor_from_cast": "60/minute",
+        "update_movie_title": "30/minute",
+        "get_movie_cast": "60/minute",
+        "get_actor_casts": "60/minute",
+    }
+    # Shed load when more requests than this are in flight in one worker,
+    # by default when every thread of the worker is busy
+    RATELIMIT_MAX_IN_FLIGHT = int(env.get("RATELIMIT_MAX_IN_FLIGHT", WEB_THREADS - 1))
+
+    # Background jobs for long running catalog operations
+    JOBS_ENABLED = env.get("JOBS_ENABLED", "true").lower() == "true"
+    JOBS_WORKERS = int(env.get("JOBS_WORKERS", 1))
+    JOBS_POLL_INTERVAL = 1
+    JOBS_RETRY_BACKOFF = 2
+    # Seconds without progress after which a running job is considered lost
+    JOBS_LEASE = int(env.get("JOBS_LEASE", 600))
+    # Deletes touching at least this many cast entries run as job
+    JOBS_CASCADE_THRESHOLD = int(env.get("JOBS_CASCADE_THRESHOLD", 200))
+
+    # Change feed (server-sent events), the log is shared by the workers on the host
+    EVENTS_ENABLED = env.get("EVENTS_ENABLED", "true").lower() == "true"
+    EVENTS_SQLITE_PATH = env.get("EVENTS_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "casting_events.db"))
+    EVENTS_POLL_INTERVAL = 0.5
+    EVENTS_RETENTION = 300
+    EVENTS_KEEPALIVE = 15
+    # Permission an API client needs for the feed, logged in users of the pages always get it
+    EVENTS_PERMISSION = env.get("EVENTS_PERMISSION", "read:cast")
+    # Open feeds per worker, each holds a thread; more get a 503
+    EVENTS_MAX_SUBSCRIBERS = int(env.get("EVENTS_MAX_SUBSCRIBERS", WEB_THREADS // 2))
+
+    # Serve the listing and cast reads from a memory-mapped catalog snapshot
+    SNAPSHOT_ENABLED = env.get("SNAPSHOT_ENABLED", "false").lower() == "true"
+    # Default: a file in the temp directory named after the database url
+    SNAPSHOT_PATH = env.get("SNAPSHOT_PATH")
+    # Seconds to wait after a change before rebuilding, so a burst of writes rebuilds once
+    SNAPSHOT_REBUILD_DELAY = 0.2
+
+    # SQL statements per request, N+1 detection and query budgets per endpoint
+    QUERY_STATS_ENABLED = env.get("QUERY_STATS_ENABLED", "false").lower() == "true"
+    # Add X-Query-Count / X-Query-Time-ms headers to the responses
+    QUERY_STATS_HEADERS = env.get("QUERY_STATS_HEADERS", "false").lower() == "true"
+    # The same statement this many times in one request is reported as N+1
+    QUERY_N_PLUS_ONE_THRESHOLD = 5
+    QUERY_BUDGETS = {
+        "index": 2,
+        "show_actor": 1,
+        "show_cast": 1,
+        "get_actor_portfolio": 1,
+        "get_actor_casts": 1,
+        "get_movie_cast": 1,
+    }
+    # Raise QueryBudgetExceeded when an endpoint runs more queries than its budget
+    QUERY_BUDGET_ENFORCE = False
+
+    # Slow query log with query plans, report with `flask slow-queries`
+    SLOW_QUERY_ENABLED = env.get("SLOW_QUERY_ENABLED", "true").lower() == "true"
+    SLOW_QUERY_THRESHOLD_MS = int(env.get("SLOW_QUERY_THRESHOLD_MS", 200))
+    SLOW_QUERY_LOG = env.get("SLOW_QUERY_LOG", os.path.join(tempfile.gettempdir(), "casting_slow_queries.log"))
+    SLOW_QUERY_EXPLAIN = True
+    # EXPLAIN ANALYZE executes the statement again (Postgres, reads only)
+    SLOW_QUERY_EXPLAIN_ANALYZE = env.get("SLOW_QUERY_EXPLAIN_ANALYZE", "false").lower() == "true"
+
+    # Duplicate actors and movies on create: "reject", "merge" or "warn"
+    DEDUPE_EXACT_POLICY = env.get("DEDUPE_EXACT_POLICY", "reject")
+    DEDUPE_NEAR_POLICY = env.get("DEDUPE_NEAR_POLICY", "warn")
+    # Similarity (0-1) of the normalized names to count as near duplicate
+    DEDUPE_SIMILARITY = 0.9
+
+    # Batch endpoint
+    BATCH_ENABLED = env.get("BATCH_ENABLED", "true").lower() == "true"
+    BATCH_MAX_REQUESTS = int(env.get("BATCH_MAX_REQUESTS", 50))
+
+    # Delta sync: changes per page and how long tombstones are kept (seconds)
+    SYNC_PAGE_SIZE = int(env.get("SYNC_PAGE_SIZE", 500))
+    SYNC_TOMBSTONE_RETENTION = int(env.get("SYNC_TOMBSTONE_RETENTION", 30 * 24 * 3600))
+
+    # Read replicas, comma separated database urls (none: everything on the primary)
+    DATABASE_REPLICA_URLS = [url.strip() for url in env.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    # Read-only endpoints served by the replicas
+    REPLICA_ROUTES = ["index", "show_actor", "show_cast", "get_movie_cast", "get_actor_casts", "get_actor_portfolio"]
+    # Seconds a client reads from the primary after a write
+    REPLICA_STICKY_SECONDS = float(env.get("REPLICA_STICKY_SECONDS", 5))
+    REPLICA_HEALTH_INTERVAL = float(env.get("REPLICA_HEALTH_INTERVAL", 10))
+
+    # Concurrent identical reads share one response (JSON endpoints only, the pages are per user)
+    COALESCE_ENABLED = env.get("COALESCE_ENABLED", "true").lower() == "true"
+    COALESCE_ROUTES = ["get_movie_cast", "get_actor_casts"]
+    # Seconds a request waits for the shared response before running itself
+    COALESCE_TIMEOUT = float(env.get("COALESCE_TIMEOUT", 5))
+
+    # Request profiling, off unless enabled
+    PROFILING_ENABLED = env.get("PROFILING_ENABLED", "false").lower() == "true"
+    PROFILING_DIR = env.get("PROFILING_DIR", os.path.join(tempfile.gettempdir(), "casting_profiles"))
+    # Profile one in every N requests, 0 to only profile on a signed X-Profile header
+    PROFILING_SAMPLE_RATE = int(env.get("PROFILING_SAMPLE_RATE", 0))
+    PROFILING_SECRET = env.get("PROFILING_SECRET")
+    PROFILING_PERMISSION = env.get("PROFILING_PERMISSION", "profile:requests")
+
 
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = env.get("DATABASE_URL")
@@ -20,4 +145,13 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = env.get("DATABASE_URL_TEST")
     TESTING = True
+    SESSION_STORE = "memory"
+    RATELIMIT_ENABLED = False
+    JOBS_ENABLED = False
+    EVENTS_ENABLED = False
+    QUERY_STATS_ENABLED = True
+    QUERY_STATS_HEADERS = True
+    QUERY_BUDGET_ENFORCE = True
+    SLOW_QUERY_ENABLED = False
+    COALESCE_ENABLED = False
     # to-do: ther testing-specific configuration options
@@ -0,0 +1,234 @@
+from difflib import SequenceMatcher
+from itertools import combinations
+
+import click
+from flask import current_app
+from sqlalchemy import func
+
+from model import db, Movie, Actor, title_key, actor_name_key, NAME_BLOCK_LENGTH
+
+# Duplicate detection
+# Actors and movies carry a normalized name key and a short prefix of it
+# (the block). Exact duplicates share the key, near duplicates are searched
+# only among the rows of the same block, both lookups use an index.
+# What happens on a duplicate is set by DEDUPE_EXACT_POLICY and
+# DEDUPE_NEAR_POLICY: "reject", "merge" or "warn".
+
+
+def similarity(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def actor_to_dict(actor):
+    return {
+        "act_id": actor.act_id,
+        "act_firstname": actor.act_firstname,
+        "act_lastname": actor.act_lastname,
+    }
+
+
+def movie_to_dict(movie):
+    return {
+        "mov_id": movie.mov_id,
+        "mov_title": movie.mov_title,
+        "mov_release": movie.mov_release,
+    }
+
+
+def find_actor_duplicates(act_firstname, act_lastname):
+    """
+    Returns the (exact, near) duplicates of an actor name
+    """
+    key = actor_name_key(act_firstname, act_lastname)
+    threshold = current_app.config.get("DEDUPE_SIMILARITY", 0.9)
+    candidates = Actor.query.filter(Actor.act_name_block == key[:NAME_BLOCK_LENGTH]).all()
+    exact = [a for a in candidates if a.act_name_key == key]
+    near = [a for a in candidates if a.act_name_key != key and similarity(a.act_name_key or "", key) >= threshold]
+    return exact, near
+
+
+def find_movie_duplicates(mov_title, mov_release):
+    """
+    Returns the (exact, near) duplicates of a movie title and release year.
+    A movie with the same title but another release year is a remake, not a duplicate.
+    """
+    key = title_key(mov_title)
+    threshold = current_app.config.get("DEDUPE_SIMILARITY", 0.9)
+    candidates = Movie.query.filter(
+        Movie.mov_title_block == key[:NAME_BLOCK_LENGTH],
+        Movie.mov_release == mov_release,
+    ).all()
+    exact = [m for m in candidates if m.mov_title_key == key]
+    near = [m for m in candidates if m.mov_title_key != key and similarity(m.mov_title_key or "", key) >= threshold]
+    return exact, near
+
+
+def check_duplicates(exact, near):
+    """
+    Applies the duplicate policies, returns (action, duplicate, warnings).
+    action is "create", "reject" or "merge"; duplicate is the row to merge
+    into or the row that caused the rejection.
+    """
+    exact_policy = current_app.config.get("DEDUPE_EXACT_POLICY", "reject")
+    near_policy = current_app.config.get("DEDUPE_NEAR_POLICY", "warn")
+    warnings = []
+
+    for policy, rows, kind in ((exact_policy, exact, "exact"), (near_policy, near, "near")):
+        if not rows:
+            continue
+        if policy == "reject":
+            return "reject", rows[0], warnings
+        if policy == "merge":
+            return "merge", rows[0], warnings
+        warnings.extend((kind, row) for row in rows)
+    return "create", None, warnings
+
+
+def merge_missing(row, values):
+    """
+    Fills the empty columns of an existing row from the posted values
+    """
+    changed = False
+    for column, value in values.items():
+        if value and getattr(row, column) is None:
+            setattr(row, column, value)
+            changed = True
+    return changed
+
+
+#----------------------------------------------------------------------------#
+# Bulk loads
+#----------------------------------------------------------------------------#
+
+def filter_bulk_duplicates(model, rows, key_column, block_column, group_column=None):
+    """
+    Checks a batch of rows (dicts) against the table and against each other.
+    The candidates of all blocks in the batch are fetched with one query.
+    Only rows with the same group_column value are compared (movie release).
+    Under the merge policy a duplicate fills the empty columns of the row it
+    duplicates, an existing row or an earlier row of the batch.
+    Returns (rows to insert, skipped rows as (index, reason), warnings).
+    """
+    exact_policy = current_app.config.get("DEDUPE_EXACT_POLICY", "reject")
+    near_policy = current_app.config.get("DEDUPE_NEAR_POLICY", "warn")
+    threshold = current_app.config.get("DEDUPE_SIMILARITY", 0.9)
+
+    def group(row):
+        # Compare as text, posted release years may be strings
+        return str(row.get(group_column.key)) if group_column is not None else None
+
+    def merge(target, row):
+        if isinstance(target, dict):
+            target.update((column, value) for column, value in row.items() if value and target.get(column) is None)
+        else:
+            merge_missing(target, row)
+
+    # (key, row) per block, the row is an existing model row or a dict of the batch
+    candidates = {}
+    blocks = {row[block_column.key] for row in rows}
+    if blocks:
+        for existing in model.query.filter(block_column.in_(blocks)):
+            existing_group = str(getattr(existing, group_column.key)) if group_column is not None else None
+            candidates.setdefault((getattr(existing, block_column.key), existing_group), []).append(
+                (getattr(existing, key_column.key) or "", existing))
+
+    accepted, skipped, warnings = [], [], []
+    for i, row in enumerate(rows):
+        key = row[key_column.key]
+        block = candidates.setdefault((row[block_column.key], group(row)), [])
+        exact = [target for other, target in block if other == key]
+        near = [target for other, target in block if other != key and similarity(other, key) >= threshold]
+
+        if exact and exact_policy != "warn":
+            if exact_policy == "merge":
+                merge(exact[0], row)
+            skipped.append((i, "duplicate" if exact_policy == "reject" else "merged"))
+            continue
+        if near and near_policy != "warn":
+            if near_policy == "merge":
+                merge(near[0], row)
+            skipped.append((i, "near duplicate" if near_policy == "reject" else "merged"))
+            continue
+        if exact or near:
+            warnings.append({"index": i, "exact": bool(exact), "near": bool(near)})
+        accepted.append(row)
+        # Later rows of the batch are checked against this one as well
+        block.append((key, row))
+    return accepted, skipped, warnings
+
+
+#----------------------------------------------------------------------------#
+# Report over the existing tables
+#----------------------------------------------------------------------------#
+
+def duplicate_report(threshold):
+    report = {"actors": {"exact": [], "near": []}, "movies": {"exact": [], "near": []}}
+
+    # Exact duplicates straight from the key index
+    exact_actor_keys = db.session.query(Actor.act_name_key) \
+        .group_by(Actor.act_name_key).having(func.count() > 1).all()
+    for (key,) in exact_actor_keys:
+        rows = Actor.query.filter(Actor.act_name_key == key).order_by(Actor.act_id).all()
+        report["actors"]["exact"].append([actor_to_dict(a) for a in rows])
+
+    exact_movie_keys = db.session.query(Movie.mov_title_key, Movie.mov_release) \
+        .group_by(Movie.mov_title_key, Movie.mov_release).having(func.count() > 1).all()
+    for key, release in exact_movie_keys:
+        rows = Movie.query.filter(Movie.mov_title_key == key, Movie.mov_release == release).order_by(Movie.mov_id).all()
+        report["movies"]["exact"].append([movie_to_dict(m) for m in rows])
+
+    # Near duplicates: only compare rows within the same block
+    def near_pairs(rows, key_of, group_of, to_dict):
+        blocks = {}
+        for row in rows:
+            blocks.setdefault(group_of(row), []).append(row)
+        pairs = []
+        for block in blocks.values():
+            for a, b in combinations(block, 2):
+                if key_of(a) != key_of(b) and similarity(key_of(a), key_of(b)) >= threshold:
+                    pairs.append([to_dict(a), to_dict(b)])
+        return pairs
+
+    actors = Actor.query.order_by(Actor.act_name_block).all()
+    report["actors"]["near"] = near_pairs(actors, lambda a: a.act_name_key or "", lambda a: a.act_name_block, actor_to_dict)
+    movies = Movie.query.order_by(Movie.mov_title_block).all()
+    report["movies"]["near"] = near_pairs(movies, lambda m: m.mov_title_key or "", lambda m: (m.mov_title_block, m.mov_release), movie_to_dict)
+    return report
+
+
+def backfill_keys():
+    """
+    Computes the name keys of rows created before the key columns existed
+    """
+    updated = 0
+    for actor in Actor.query.filter(Actor.act_name_key.is_(None)):
+        actor.update_name_key('act_firstname', actor.act_firstname)
+        updated += 1
+    for movie in Movie.query.filter(Movie.mov_title_key.is_(None)):
+        movie.update_title_key('mov_title', movie.mov_title)
+        updated += 1
+    db.session.commit()
+    return updated
+
+
+def init_dedupe(app):
+    @app.cli.group("dedupe")
+    def dedupe():
+        """Duplicate actors and movies."""
+
+    @dedupe.command("backfill")
+    def backfill():
+        """Compute the name keys of existing rows."""
+        click.echo(f"Updated {backfill_keys()} rows")
+
+    @dedupe.command("report")
+    @click.option("--threshold", default=None, type=float, help="Similarity for near duplicates, defaults to DEDUPE_SIMILARITY")
+    def report(threshold):
+        """List exact and near duplicates in the catalog."""
+        result = duplicate_report(threshold or app.config["DEDUPE_SIMILARITY"])
+        for table in ("actors", "movies"):
+            click.echo(f"{table}: {len(result[table]['exact'])} exact groups, {len(result[table]['near'])} near pairs")
+            for group in result[table]["exact"]:
+                click.echo(f"  exact: {group}")
+            for pair in result[table]["near"]:
+                click.echo(f"  near:  {pair}")
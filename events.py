@@ -0,0 +1,230 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import Response, current_app, g, jsonify, request, session
+
+from auth import check_permissions, verify_request_token
+
+# Change feed
+# Write handlers publish movie, actor and cast events after their commit.
+# Events are appended to a local SQLite log which every worker process polls,
+# so subscribers connected to any worker receive changes made by all workers.
+# /events streams them to the browser as server-sent events, to logged in
+# users of the pages or to API clients with a token with EVENTS_PERMISSION.
+
+
+class EventBroker:
+    """
+    Fans out events from the shared log to the subscribers of this worker
+    """
+
+    def __init__(self, path, poll_interval=0.5, retention=300, max_subscribers=None):
+        self.path = path
+        self.max_subscribers = max_subscribers
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._poller = None
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " created REAL NOT NULL,"
+                " payload TEXT NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def publish(self, event):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO events (created, payload) VALUES (?, ?)",
+                (time.time(), json.dumps(event)),
+            )
+
+    def since(self, last_id):
+        rows = self._connect().execute(
+            "SELECT id, payload FROM events WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        return [(event_id, json.loads(payload)) for event_id, payload in rows]
+
+    def last_id(self):
+        row = self._connect().execute("SELECT MAX(id) FROM events").fetchone()
+        return row[0] or 0
+
+    def subscribe(self):
+        """
+        New subscriber queue, None when this worker has max_subscribers already
+        """
+        subscriber = queue.Queue(maxsize=1000)
+        with self._lock:
+            if self.max_subscribers and len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscriber)
+            # Only poll the log while someone in this worker is listening
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, name="event-poller", daemon=True)
+                self._poller.start()
+        return subscriber
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _poll(self):
+        last_id = self.last_id()
+        last_purge = time.time()
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._poller = None
+                    return
+                subscribers = list(self._subscribers)
+
+            for event_id, event in self.since(last_id):
+                last_id = event_id
+                for subscriber in subscribers:
+                    try:
+                        subscriber.put_nowait((event_id, event))
+                    except queue.Full:
+                        # Slow client, it will have to reload
+                        pass
+
+            if time.time() - last_purge > self.retention:
+                with self._connect() as conn:
+                    conn.execute("DELETE FROM events WHERE created < ?", (time.time() - self.retention,))
+                last_purge = time.time()
+
+            time.sleep(self.poll_interval)
+
+
+def publish(event_type, mov_id=None, act_id=None, **data):
+    """
+    Publishes a change event, call after the change is committed
+    """
+    broker = current_app.extensions.get("events")
+    if broker is None:
+        return
+    event = {"type": event_type, "mov_id": mov_id, "act_id": act_id, "data": data}
+    # A transactional batch commits at the end, hold the events until then
+    pending = g.get("pending_events")
+    if pending is not None:
+        pending.append(event)
+        return
+    publish_event(broker, event)
+
+
+def publish_event(broker, event):
+    try:
+        broker.publish(event)
+    except sqlite3.Error as err_publish:
+        # The change itself is committed, a missed event only costs a reload
+        print(str(err_publish))
+
+
+def publish_pending(events):
+    """
+    Publishes the events held back during a transactional batch
+    """
+    broker = current_app.extensions.get("events")
+    if broker is None:
+        return
+    for event in events:
+        publish_event(broker, event)
+
+
+# Deleting a movie or actor also deletes its cast entries, without a
+# cast.deleted event per entry. These go to every feed, so the pages of the
+# other side (?actor= for a movie, ?movie= for an actor) can drop the rows.
+CASCADING_DELETES = {"movie.deleted", "actor.deleted"}
+
+
+def matches(event, movies, actors):
+    if not movies and not actors:
+        return True
+    if event.get("type") in CASCADING_DELETES:
+        return True
+    return event.get("mov_id") in movies or event.get("act_id") in actors
+
+
+def format_event(event_id, event):
+    return f"id: {event_id}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+def init_events(app):
+    if not app.config.get("EVENTS_ENABLED"):
+        return
+
+    broker = EventBroker(
+        app.config["EVENTS_SQLITE_PATH"],
+        poll_interval=app.config.get("EVENTS_POLL_INTERVAL", 0.5),
+        retention=app.config.get("EVENTS_RETENTION", 300),
+        max_subscribers=app.config.get("EVENTS_MAX_SUBSCRIBERS"),
+    )
+    app.extensions["events"] = broker
+    keepalive = app.config.get("EVENTS_KEEPALIVE", 15)
+    permission = app.config.get("EVENTS_PERMISSION", "read:cast")
+
+    # Change feed as server-sent events, filter with ?movie=<id>&actor=<id>
+    @app.route('/events', methods=['GET'])
+    def event_stream():
+        # The pages can't send a bearer token with EventSource, they use the login session
+        if session.get("user") is None:
+            check_permissions(permission, verify_request_token())
+
+        movies = set(request.args.getlist('movie', type=int))
+        actors = set(request.args.getlist('actor', type=int))
+        last_event_id = request.headers.get('Last-Event-ID', type=int)
+
+        # Every open feed holds a thread of the worker, keep some for the other requests
+        subscriber = broker.subscribe()
+        if subscriber is None:
+            return jsonify({"success": False, "error": "Too many open feeds, try again later"}), 503, {"Retry-After": "30"}
+
+        def stream():
+            # Id of the last event sent, replayed events may also arrive via the queue
+            sent = last_event_id or 0
+            try:
+                yield "retry: 3000\n\n"
+                # Replay what the client missed while reconnecting
+                if last_event_id is not None:
+                    for event_id, event in broker.since(last_event_id):
+                        sent = event_id
+                        if matches(event, movies, actors):
+                            yield format_event(event_id, event)
+                while True:
+                    try:
+                        event_id, event = subscriber.get(timeout=keepalive)
+                    except queue.Empty:
+                        yield ": keepalive\n\n"
+                        continue
+                    if event_id <= sent:
+                        continue
+                    sent = event_id
+                    if matches(event, movies, actors):
+                        yield format_event(event_id, event)
+            finally:
+                broker.unsubscribe(subscriber)
+
+        response = Response(stream(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        # Also when the client is gone before the stream started
+        response.call_on_close(lambda: broker.unsubscribe(subscriber))
+        return response
@@ -0,0 +1,185 @@
+from flask import g, jsonify, request
+
+from model import db, Movie, Actor, Cast
+from snapshot import current_snapshot
+
+# Sparse fieldsets
+# The JSON read endpoints take ?fields=a,b (keys of the list items) and
+# ?include=movie or ?include=actor (the movie or actor the list belongs to).
+# Only the requested columns are selected, in one outer join query from the
+# movie or actor to its casts. Unknown names are rejected before the token
+# is verified or the database is touched.
+
+MOVIE_COLUMNS = {
+    "mov_id": Movie.mov_id,
+    "mov_title": Movie.mov_title,
+    "mov_release": Movie.mov_release,
+    "mov_language": Movie.mov_language,
+}
+
+ACTOR_COLUMNS = {
+    "act_id": Actor.act_id,
+    "act_firstname": Actor.act_firstname,
+    "act_lastname": Actor.act_lastname,
+    "act_language": Actor.act_language,
+    "act_gender": Actor.act_gender,
+}
+
+
+class FieldsetError(Exception):
+    def __init__(self, message, status_code=400):
+        self.message = message
+        self.status_code = status_code
+
+
+class Selection:
+    def __init__(self, fields, include):
+        self.fields = fields
+        self.include = include
+
+
+class CastListFields:
+    """
+    Fields of the cast list of a movie or an actor (the parent). fields maps
+    the output keys to columns of the other side of the cast or Cast.cas_role.
+    """
+
+    def __init__(self, parent, fields, default):
+        self.parent = parent
+        self.fields = fields
+        self.default = default
+        if parent is Movie:
+            self.parent_name, self.parent_columns = "movie", MOVIE_COLUMNS
+            self.related = Actor
+            self.parent_join = Movie.mov_id == Cast.mov_id
+            self.related_join = Actor.act_id == Cast.act_id
+            self.parent_key = Movie.mov_id
+        else:
+            self.parent_name, self.parent_columns = "actor", ACTOR_COLUMNS
+            self.related = Movie
+            self.parent_join = Actor.act_id == Cast.act_id
+            self.related_join = Movie.mov_id == Cast.mov_id
+            self.parent_key = Actor.act_id
+
+    def parse(self, args):
+        fields = self.default
+        if args.get("fields") is not None:
+            fields = tuple(dict.fromkeys(name.strip() for name in args["fields"].split(",") if name.strip()))
+            unknown = [name for name in fields if name not in self.fields]
+            if unknown or not fields:
+                raise FieldsetError(f"Unknown field(s): {', '.join(unknown) or '(none)'}. "
+                                    f"Available: {', '.join(self.fields)}")
+
+        include = ()
+        if args.get("include"):
+            include = tuple(name.strip() for name in args["include"].split(",") if name.strip())
+            unknown = [name for name in include if name != self.parent_name]
+            if unknown:
+                raise FieldsetError(f"Unknown include(s): {', '.join(unknown)}. Available: {self.parent_name}")
+        return Selection(fields, include)
+
+    def load(self, parent_id, selection):
+        """
+        Returns (parent dict or None, cast list) or None when the parent doesn't exist
+        """
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            return self.from_snapshot(snapshot, parent_id, selection)
+        return self.query(parent_id, selection)
+
+    def query(self, parent_id, selection):
+        columns = [Cast.cas_id.label("_cas_id")]
+        columns += [self.fields[name].label(name) for name in selection.fields]
+        if selection.include:
+            columns += [column.label(f"_parent_{name}") for name, column in self.parent_columns.items()]
+
+        rows = db.session.query(*columns) \
+            .select_from(self.parent) \
+            .outerjoin(Cast, self.parent_join) \
+            .outerjoin(self.related, self.related_join) \
+            .filter(self.parent_key == parent_id) \
+            .order_by(Cast.cas_id) \
+            .all()
+        if not rows:
+            return None
+
+        parent = None
+        if selection.include:
+            parent = {name: getattr(rows[0], f"_parent_{name}") for name in self.parent_columns}
+        items = [self.item({name: getattr(row, name) for name in selection.fields})
+                 for row in rows if row._cas_id is not None]
+        return parent, items
+
+    def from_snapshot(self, snapshot, parent_id, selection):
+        if self.parent is Movie:
+            parent_row, entries = snapshot.movie(parent_id), snapshot.movie_cast
+        else:
+            parent_row, entries = snapshot.actor(parent_id), snapshot.actor_casts
+        if parent_row is None:
+            return None
+
+        parent = None
+        if selection.include:
+            parent = {name: getattr(parent_row, name) for name in self.parent_columns}
+        items = []
+        for related_row, cas_role in entries(parent_id):
+            items.append(self.item({
+                name: cas_role if self.fields[name].key == "cas_role" else getattr(related_row, self.fields[name].key)
+                for name in selection.fields
+            }))
+        return parent, items
+
+    def item(self, values):
+        # The movie cast always left out roles which are not set
+        if self.parent is Movie and values.get("cas_role", "") is None:
+            del values["cas_role"]
+        return values
+
+    def response(self, parent, items):
+        body = {"success": True, "cast_list": items}
+        if parent is not None:
+            body[self.parent_name] = parent
+        return jsonify(body)
+
+
+# Fields of each read endpoint, the defaults are what the endpoints returned before
+FIELDSETS = {
+    "get_movie_cast": CastListFields(
+        Movie,
+        fields=dict(ACTOR_COLUMNS, cas_role=Cast.cas_role),
+        default=("act_id", "act_firstname", "act_lastname", "cas_role"),
+    ),
+    "get_actor_casts": CastListFields(
+        Actor,
+        fields={"title": Movie.mov_title, "role": Cast.cas_role, "mov_id": Movie.mov_id,
+                "mov_release": Movie.mov_release, "mov_language": Movie.mov_language},
+        default=("title", "role"),
+    ),
+    "get_actor_portfolio": CastListFields(
+        Actor,
+        fields={"mov_id": Movie.mov_id, "title": Movie.mov_title, "role": Cast.cas_role,
+                "mov_release": Movie.mov_release, "mov_language": Movie.mov_language},
+        default=("mov_id", "title", "role"),
+    ),
+}
+
+
+def current_selection():
+    """
+    Fieldset and parsed selection of the current request
+    """
+    return FIELDSETS[request.endpoint], g.selection
+
+
+def init_fieldsets(app):
+    @app.before_request
+    def parse_fieldset():
+        fieldset = FIELDSETS.get(request.endpoint)
+        if fieldset is None:
+            return None
+        try:
+            g.selection = fieldset.parse(request.args)
+        except FieldsetError as err_fields:
+            return jsonify({"success": False, "error": err_fields.status_code,
+                            "message": err_fields.message}), err_fields.status_code
+        return None
@@ -0,0 +1,366 @@
+import json
+import threading
+import time
+import traceback
+
+from flask import jsonify, request, url_for
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, OperationalError, SQLAlchemyError
+
+from auth import BATCH_PAYLOAD, verify_request_token
+from model import db, Job, Movie, Actor, Cast, title_key, actor_name_key, NAME_BLOCK_LENGTH
+from events import publish
+from dedupe import filter_bulk_duplicates
+from sync import stamp_rows
+
+# Background jobs
+# Long running catalog operations (cascading deletes, bulk loads) are stored
+# in the jobs table and executed by worker threads, so the request can return
+# 202 right away. Jobs failing on a transient database error are retried
+# with exponential backoff, other failures are final. A running
+# job which made no progress for JOBS_LEASE seconds lost its worker and is
+# queued again.
+
+# Registered job functions by name
+JOBS = {}
+
+
+def job(name):
+    """
+    Registers a function as job. It is called as f(progress, **params)
+    """
+    def register(f):
+        JOBS[name] = f
+        return f
+    return register
+
+
+def jobs_enabled(app):
+    return app.config.get("JOBS_ENABLED", False)
+
+
+def enqueue(name, max_attempts=3, owner=None, **params):
+    """
+    Adds a job to the queue and returns its id, owner is the token subject which may see it
+    """
+    if name not in JOBS:
+        raise ValueError(f"Unknown job: {name}")
+    now = time.time()
+    new_job = Job(
+        job_name=name,
+        job_params=json.dumps(params),
+        job_status='queued',
+        job_attempts=0,
+        job_max_attempts=max_attempts,
+        job_progress=0,
+        job_run_at=now,
+        job_created=now,
+        job_owner=owner,
+    )
+    db.session.add(new_job)
+    db.session.commit()
+    return new_job.job_id
+
+
+def accepted(job_id):
+    """
+    Response for a request which was handed off to a job
+    """
+    response = jsonify({"success": True, "job_id": job_id, "status": "queued"})
+    response.status_code = 202
+    response.headers["Location"] = url_for("get_job", job_id=job_id)
+    return response
+
+
+def job_to_dict(queued_job):
+    return {
+        "job_id": queued_job.job_id,
+        "name": queued_job.job_name,
+        "status": queued_job.job_status,
+        "attempts": queued_job.job_attempts,
+        "progress": queued_job.job_progress,
+        "total": queued_job.job_total,
+        "result": json.loads(queued_job.job_result) if queued_job.job_result else None,
+        "error": queued_job.job_error,
+    }
+
+
+#----------------------------------------------------------------------------#
+# Worker
+#----------------------------------------------------------------------------#
+
+def requeue_stale_jobs(lease):
+    """
+    Jobs whose worker died (no progress for lease seconds) are queued again,
+    or failed when they used all their attempts
+    """
+    now = time.time()
+    stale = [Job.job_status == 'running', Job.job_claimed < now - lease]
+    failed = db.session.query(Job) \
+        .filter(*stale, Job.job_attempts >= Job.job_max_attempts) \
+        .update({"job_status": 'failed', "job_error": "Worker lost", "job_finished": now}, synchronize_session=False)
+    requeued = db.session.query(Job) \
+        .filter(*stale) \
+        .update({"job_status": 'queued', "job_run_at": now}, synchronize_session=False)
+    db.session.commit()
+    if failed or requeued:
+        print(f"Requeued {requeued} and failed {failed} jobs of lost workers")
+
+
+def claim_next_job():
+    """
+    Claims the oldest due job. The conditional update makes sure only one
+    worker (thread or process) gets it.
+    """
+    candidates = db.session.query(Job.job_id) \
+        .filter(Job.job_status == 'queued', Job.job_run_at <= time.time()) \
+        .order_by(Job.job_run_at) \
+        .limit(5).all()
+    for (job_id,) in candidates:
+        claimed = db.session.query(Job) \
+            .filter(Job.job_id == job_id, Job.job_status == 'queued') \
+            .update({"job_status": 'running', "job_attempts": Job.job_attempts + 1, "job_claimed": time.time()},
+                    synchronize_session=False)
+        db.session.commit()
+        if claimed == 1:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def run_job(app, queued_job):
+    job_id = queued_job.job_id
+
+    def progress(done, total=None):
+        db.session.query(Job).filter(Job.job_id == job_id) \
+            .update({"job_progress": done, "job_total": total, "job_claimed": time.time()}, synchronize_session=False)
+        db.session.commit()
+
+    try:
+        result = JOBS[queued_job.job_name](progress, **json.loads(queued_job.job_params))
+        queued_job = db.session.get(Job, job_id)
+        queued_job.job_status = 'done'
+        queued_job.job_result = json.dumps(result)
+        queued_job.job_error = None
+        queued_job.job_finished = time.time()
+        db.session.commit()
+    except Exception as err_job:
+        db.session.rollback()
+        print(f"Job {job_id} failed:")
+        traceback.print_exc()
+        queued_job = db.session.get(Job, job_id)
+        # Only a short message for /jobs, the traceback stays in the log
+        queued_job.job_error = job_error_message(err_job)
+        if is_transient(err_job) and queued_job.job_attempts < queued_job.job_max_attempts:
+            # Retry with exponential backoff
+            backoff = app.config.get("JOBS_RETRY_BACKOFF", 2) * 2 ** (queued_job.job_attempts - 1)
+            queued_job.job_status = 'queued'
+            queued_job.job_run_at = time.time() + backoff
+        else:
+            queued_job.job_status = 'failed'
+            queued_job.job_finished = time.time()
+        db.session.commit()
+
+
+def is_transient(err):
+    """
+    Whether a failed job may succeed when run again: lost connections, lock
+    timeouts and deadlocks. Anything else fails the same way on every attempt.
+    """
+    return isinstance(err, OperationalError)
+
+
+def job_error_message(err):
+    if isinstance(err, DBAPIError):
+        return f"Database error ({type(err.orig).__name__})"
+    return f"{type(err).__name__}: {str(err)[:200]}"
+
+
+def worker_loop(app, stop):
+    interval = app.config.get("JOBS_POLL_INTERVAL", 1)
+    lease = app.config.get("JOBS_LEASE", 600)
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                requeue_stale_jobs(lease)
+                queued_job = claim_next_job()
+                if queued_job is not None:
+                    run_job(app, queued_job)
+                    continue
+            except SQLAlchemyError as err_worker:
+                db.session.rollback()
+                print(str(err_worker))
+            finally:
+                db.session.remove()
+        stop.wait(interval)
+
+
+def start_workers(app):
+    stop = threading.Event()
+    for i in range(app.config.get("JOBS_WORKERS", 1)):
+        threading.Thread(target=worker_loop, args=(app, stop), name=f"job-worker-{i}", daemon=True).start()
+    return stop
+
+
+def init_jobs(app):
+    # Job status endpoint
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    def get_job(job_id):
+        # Any valid token, but only the one which started the job sees it
+        payload = request.environ.get(BATCH_PAYLOAD) or verify_request_token()
+        queued_job = db.session.get(Job, job_id)
+        if queued_job is None or queued_job.job_owner != payload.get("sub"):
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': True, 'job': job_to_dict(queued_job)})
+
+    @app.cli.group("jobs")
+    def jobs_cli():
+        """Background jobs."""
+
+    @jobs_cli.command("work")
+    def work():
+        """Run JOBS_WORKERS job workers in the foreground."""
+        stop = start_workers(app)
+        try:
+            stop.wait()
+        except KeyboardInterrupt:
+            stop.set()
+
+    # Importing the app (tests, flask db/dedupe/sync commands) must not start
+    # workers, the web processes start them with their first request
+    if not jobs_enabled(app) or app.testing or app.config.get("JOBS_WORKERS", 1) < 1:
+        return
+    start_lock = threading.Lock()
+
+    @app.before_request
+    def start_job_workers():
+        if "jobs" in app.extensions:
+            return
+        with start_lock:
+            if "jobs" not in app.extensions:
+                app.extensions["jobs"] = start_workers(app)
+
+
+#----------------------------------------------------------------------------#
+# Catalog jobs
+#----------------------------------------------------------------------------#
+
+# Rows handled per commit in the catalog jobs
+BATCH_SIZE = 500
+
+
+def delete_casts_in_batches(progress, column, value):
+    total = db.session.query(Cast).filter(column == value).count()
+    deleted = 0
+    while True:
+        ids = [cas_id for (cas_id,) in db.session.query(Cast.cas_id).filter(column == value).limit(BATCH_SIZE)]
+        if not ids:
+            break
+        db.session.query(Cast).filter(Cast.cas_id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        progress(deleted, total)
+    return deleted
+
+
+@job("delete_movie")
+def delete_movie_job(progress, mov_id):
+    """
+    Deletes a movie together with its cast entries
+    """
+    deleted = delete_casts_in_batches(progress, Cast.mov_id, mov_id)
+    db.session.query(Movie).filter(Movie.mov_id == mov_id).delete(synchronize_session=False)
+    db.session.commit()
+    publish("movie.deleted", mov_id=mov_id)
+    return {"mov_id": mov_id, "casts_deleted": deleted}
+
+
+@job("delete_actor")
+def delete_actor_job(progress, act_id):
+    """
+    Deletes an actor together with its cast entries
+    """
+    deleted = delete_casts_in_batches(progress, Cast.act_id, act_id)
+    db.session.query(Actor).filter(Actor.act_id == act_id).delete(synchronize_session=False)
+    db.session.commit()
+    publish("actor.deleted", act_id=act_id)
+    return {"act_id": act_id, "casts_deleted": deleted}
+
+
+def bulk_create(progress, model, rows, required, key_column, block_column, group_column=None):
+    created = 0
+    errors = []
+    warnings = []
+    batch = []
+
+    def insert_batch(batch):
+        # Drop duplicates according to the dedupe policies before inserting
+        indexes = [i for i, _ in batch]
+        accepted, skipped, found = filter_bulk_duplicates(
+            model, [row for _, row in batch], key_column, block_column, group_column)
+        errors.extend({"index": indexes[j], "error": reason} for j, reason in skipped)
+        warnings.extend(dict(warning, index=indexes[warning["index"]]) for warning in found)
+        if accepted:
+            stamp_rows(model, accepted)
+            # An ORM insert statement, so the do_orm_execute listeners (snapshot) see it
+            db.session.execute(insert(model), accepted)
+        db.session.commit()
+        return len(accepted)
+
+    for i, row in enumerate(rows):
+        if row is None:
+            errors.append({"index": i, "error": "Not an object"})
+            continue
+        if not all(row.get(field) for field in required):
+            errors.append({"index": i, "error": f"Missing one of {', '.join(required)}"})
+            continue
+        batch.append((i, row))
+        if len(batch) >= BATCH_SIZE:
+            created += insert_batch(batch)
+            batch = []
+            progress(i + 1, len(rows))
+    if batch:
+        created += insert_batch(batch)
+    progress(len(rows), len(rows))
+    return {"created": created, "errors": errors, "warnings": warnings}
+
+
+@job("bulk_create_movies")
+def bulk_create_movies_job(progress, movies):
+    rows = []
+    for m in movies:
+        if not isinstance(m, dict):
+            rows.append(None)
+            continue
+        # Bulk inserts skip the model validators, so set the name keys here
+        key = title_key(m.get('mov_title'))
+        rows.append({"mov_title": m.get('mov_title'), "mov_release": m.get('mov_release'), "mov_language": m.get('mov_language'),
+                     "mov_title_key": key, "mov_title_block": key[:NAME_BLOCK_LENGTH]})
+    result = bulk_create(progress, Movie, rows, ('mov_title', 'mov_release'),
+                         Movie.mov_title_key, Movie.mov_title_block, Movie.mov_release)
+    # Bulk inserts don't return the new ids, pages reload the list instead
+    publish("movie.bulk_created", created=result["created"])
+    return result
+
+
+@job("bulk_create_actors")
+def bulk_create_actors_job(progress, actors):
+    rows = []
+    for a in actors:
+        if not isinstance(a, dict):
+            rows.append(None)
+            continue
+        key = actor_name_key(a.get('act_firstname'), a.get('act_lastname'))
+        rows.append({"act_firstname": a.get('act_firstname'), "act_lastname": a.get('act_lastname'),
+                     "act_language": a.get('act_language'), "act_gender": a.get('act_gender'),
+                     "act_name_key": key, "act_name_block": key[:NAME_BLOCK_LENGTH]})
+    result = bulk_create(progress, Actor, rows, ('act_firstname', 'act_lastname'),
+                         Actor.act_name_key, Actor.act_name_block)
+    publish("actor.bulk_created", created=result["created"])
+    return result
+
+
+def run_inline(name, **params):
+    """
+    Runs a job within the request, used when the job queue is disabled
+    """
+    return JOBS[name](lambda done, total=None: None, **params)
@@ -1,8 +1,43 @@
+import re
+import unicodedata
+
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import UniqueConstraint, CheckConstraint
+from sqlalchemy.orm import validates
+
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# Length of the normalized name prefix used to find near duplicates
+NAME_BLOCK_LENGTH = 4
+# Length of the normalized name keys
+TITLE_KEY_LENGTH = 30
+NAME_KEY_LENGTH = 51
+
+def normalize_name(*parts):
+    """
+    Normalized key of a name: no accents, punctuation, case or extra spaces.
+    "Bryce Dallas", "Howard " and "bryce  dallas", "HOWARD" get the same key.
+    """
+    text = " ".join(part for part in parts if part)
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[^\w]+', ' ', text.casefold())
+    return " ".join(text.split())
+
+def title_key(title):
+    """
+    Normalized key of a movie title, cut to the column: casefold and NFKD can
+    make it longer than the title ("ß" becomes "ss")
+    """
+    return normalize_name(title)[:TITLE_KEY_LENGTH]
 
-db = SQLAlchemy()
+def actor_name_key(firstname, lastname):
+    """
+    Normalized key of an actor name, cut to the column like title_key
+    """
+    return normalize_name(firstname, lastname)[:NAME_KEY_LENGTH]
 
 class Movie(db.Model):
     """
@@ -15,8 +50,23 @@ class Movie(db.Model):
     mov_title = db.Column(db.String(30), nullable=False)
     mov_release = db.Column(db.Integer, CheckConstraint('mov_release >= 1920 AND mov_release <= 2030'), nullable=True)
     mov_language = db.Column(db.String(2), nullable=True)
-
-    __table_args__ = (UniqueConstraint('mov_id', 'mov_title', 'mov_release'),)
+    # Normalized title, used to find duplicate movies (see dedupe.py)
+    mov_title_key = db.Column(db.String(TITLE_KEY_LENGTH), nullable=True)
+    mov_title_block = db.Column(db.String(NAME_BLOCK_LENGTH), nullable=True, index=True)
+    # Change version and time, set on every write (see sync.py)
+    mov_version = db.Column(db.BigInteger, nullable=True, index=True)
+    mov_updated = db.Column(db.Float, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('mov_id', 'mov_title', 'mov_release'),
+        db.Index('ix_movies_title_key_release', 'mov_title_key', 'mov_release'),
+    )
+
+    @validates('mov_title')
+    def update_title_key(self, key, value):
+        self.mov_title_key = title_key(value)
+        self.mov_title_block = self.mov_title_key[:NAME_BLOCK_LENGTH]
+        return value
     
     def __repr__(self):
         return f'<Movie {self.mov_id} {self.mov_title} {self.mov_release} {self.mov_language}>'
@@ -33,6 +83,20 @@ class Actor(db.Model):
     act_lastname = db.Column(db.String(25), nullable=False)
     act_language = db.Column(db.String(2), nullable=True)
     act_gender = db.Column(db.String(6), nullable=True)
+    # Normalized full name, used to find duplicate actors (see dedupe.py)
+    act_name_key = db.Column(db.String(NAME_KEY_LENGTH), nullable=True, index=True)
+    act_name_block = db.Column(db.String(NAME_BLOCK_LENGTH), nullable=True, index=True)
+    # Change version and time, set on every write (see sync.py)
+    act_version = db.Column(db.BigInteger, nullable=True, index=True)
+    act_updated = db.Column(db.Float, nullable=True)
+
+    @validates('act_firstname', 'act_lastname')
+    def update_name_key(self, key, value):
+        firstname = value if key == 'act_firstname' else self.act_firstname
+        lastname = value if key == 'act_lastname' else self.act_lastname
+        self.act_name_key = actor_name_key(firstname, lastname)
+        self.act_name_block = self.act_name_key[:NAME_BLOCK_LENGTH]
+        return value
 
     def __repr__(self):
         return f'<Actor {self.act_id} {self.act_firstname} {self.act_lastname} {self.act_language} {self.act_gender}>'
@@ -49,6 +113,9 @@ class Cast(db.Model):
     mov_id = db.Column(db.Integer, db.ForeignKey('movies.mov_id'), nullable=False)
     act_id = db.Column(db.Integer, db.ForeignKey('actors.act_id'), nullable=False)
     cas_role = db.Column(db.String(35), nullable=True)
+    # Change version and time, set on every write (see sync.py)
+    cas_version = db.Column(db.BigInteger, nullable=True, index=True)
+    cas_updated = db.Column(db.Float, nullable=True)
 
     # Amake sure the relation is unique, to enable consistant deleting movies.
     __table_args__ = (UniqueConstraint('mov_id', 'act_id', 'cas_role'),)
@@ -59,45 +126,65 @@ class Cast(db.Model):
     def __repr__(self):
         return f'<Cast {self.cas_id} {self.mov_id} {self.act_id} {self.cas_role}>'
 
+class Job(db.Model):
+    """
+    Represents a background job in the database.
+    Jobs are picked up by the worker threads in jobs.py.
+
+    """
+
+    __tablename__ = 'jobs'
+    job_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    job_name = db.Column(db.String(50), nullable=False)
+    job_params = db.Column(db.Text, nullable=False, default='{}')
+    job_status = db.Column(db.String(10), nullable=False, default='queued', index=True)
+    job_attempts = db.Column(db.Integer, nullable=False, default=0)
+    job_max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    job_progress = db.Column(db.Integer, nullable=False, default=0)
+    job_total = db.Column(db.Integer, nullable=True)
+    job_result = db.Column(db.Text, nullable=True)
+    job_error = db.Column(db.Text, nullable=True)
+    job_run_at = db.Column(db.Float, nullable=False)
+    job_created = db.Column(db.Float, nullable=False)
+    job_finished = db.Column(db.Float, nullable=True)
+    # Token subject which started the job, only it can see the job
+    job_owner = db.Column(db.String(100), nullable=True)
+    # Last sign of life of the worker running the job, renewed with the progress
+    job_claimed = db.Column(db.Float, nullable=True)
+
+    def __repr__(self):
+        return f'<Job {self.job_id} {self.job_name} {self.job_status}>'
+
+class Tombstone(db.Model):
+    """
+    Represents a deleted movie, actor or cast entry.
+    Tells the replicas which rows to remove (see sync.py).
+
+    """
+
+    __tablename__ = 'tombstones'
+    tom_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    tom_table = db.Column(db.String(10), nullable=False)
+    tom_row_id = db.Column(db.Integer, nullable=False)
+    tom_version = db.Column(db.BigInteger, nullable=False, index=True)
+    tom_deleted = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<Tombstone {self.tom_table} {self.tom_row_id} {self.tom_version}>'
+
+class SyncCounter(db.Model):
+    """
+    Last change version handed out, one row per counter.
+
+    """
+
+    __tablename__ = 'sync_counters'
+    syn_name = db.Column(db.String(20), primary_key=True)
+    syn_value = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f'<SyncCounter {self.syn_name} {self.syn_value}>'
+
 def create_tables():
     with db.app.app.context():
         db.create_all()
-
-# Get all movie casts where selected actor was part of.
-def queryCastByActor(act_id):
-    try:
-        actor = Actor.query.get(act_id)
-
-        if actor:
-            # Use actor.casts to get the list of movies they have acted in
-            casts = [
-                {"title": cast.movie.mov_title, "role": cast.cas_role}
-                for cast in actor.casts
-            ]
-            return casts
-        else:
-            return None  # Return None if actor not found
-
-    except SQLAlchemyError as act_retrieve_error:
-        print(str(act_retrieve_error))
-        return None
-
-
-# Get all movies where selected actor performed in.
-def queryMovieByActor(act_id):
-    try:
-        actor = Actor.query.get(act_id)
-
-        if actor:
-            # Use actor.casts to get the list of movies they have acted in
-            movies = [
-                {"title": cast.movie.mov_title, "role": cast.cas_role}
-                for cast in actor.casts
-            ]
-            return movies
-        else:
-            return None  # Return None if actor not found
-
-    except SQLAlchemyError as act_retrieve_error:
-        print(str(act_retrieve_error))
-        return None
\ No newline at end of file
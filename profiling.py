@@ -0,0 +1,141 @@
+import cProfile
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+import click
+from flask import current_app, request
+
+from auth import AuthError, check_permissions
+
+# Request profiling
+# A request runs under cProfile when it carries a valid X-Profile header
+# (signed with PROFILING_SECRET, see `flask profile sign`) and its token has
+# PROFILING_PERMISSION, or when it is one of every PROFILING_SAMPLE_RATE
+# requests (any token, but only tokens with PROFILING_PERMISSION get the
+# X-Profile-Id back). The stats are written to PROFILING_DIR as a pstats file (open it
+# with snakeviz, flameprof, gprof2dot or python -m pstats) next to a JSON file
+# with the route and timing. Only routes protected by requires_auth are
+# profiled; when profiling is disabled requires_auth doesn't even look.
+
+PROFILE_HEADER = "X-Profile"
+
+
+def sign(secret, path, expires):
+    """
+    Value of the X-Profile header for requests to path until expires (unix time)
+    """
+    signature = hmac.new(secret.encode(), f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}:{signature}"
+
+
+def verify_signature(secret, value, path):
+    expires, _, signature = value.partition(":")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(sign(secret, path, expires), f"{expires}:{signature}")
+
+
+class Profiler:
+    def __init__(self, directory, sample_rate=0, secret=None, permission=None):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.permission = permission
+        self._counter = itertools.count(1)
+        # cProfile can't run two profiles at the same time
+        self._lock = threading.Lock()
+
+    def permitted(self, payload):
+        try:
+            check_permissions(self.permission, payload)
+            return True
+        except AuthError:
+            return False
+
+    def trigger(self, payload):
+        """
+        Why the current request should be profiled, None when it shouldn't
+        """
+        value = request.headers.get(PROFILE_HEADER)
+        if value is not None and self.secret:
+            if not verify_signature(self.secret, value, request.path):
+                print(f"Ignoring invalid {PROFILE_HEADER} header for {request.path}")
+            elif self.permitted(payload):
+                return "header"
+            else:
+                print(f"Ignoring {PROFILE_HEADER} header, token lacks {self.permission}")
+        if self.sample_rate and next(self._counter) % self.sample_rate == 0:
+            return "sample"
+        return None
+
+    def run(self, trigger, f, payload, *args, **kwargs):
+        if not self._lock.acquire(blocking=False):
+            return f(payload, *args, **kwargs)
+        try:
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                response = current_app.make_response(f(payload, *args, **kwargs))
+            finally:
+                profile.disable()
+                duration = time.perf_counter() - start
+        finally:
+            self._lock.release()
+
+        name = self.save(profile, trigger, duration, response.status_code)
+        # A sampled request can come from any token, don't tell it about the profile
+        if trigger == "header" or self.permitted(payload):
+            response.headers["X-Profile-Id"] = name
+        return response
+
+    def save(self, profile, trigger, duration, status_code):
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = re.sub(r"[^\w.-]", "_", request.endpoint or "unknown")
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{duration * 1000:.0f}ms-{os.getpid()}"
+        profile.dump_stats(os.path.join(self.directory, name + ".prof"))
+        with open(os.path.join(self.directory, name + ".json"), "w") as f:
+            json.dump({
+                "endpoint": request.endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": status_code,
+                "duration_ms": round(duration * 1000, 1),
+                "trigger": trigger,
+                "time": time.time(),
+            }, f)
+        print(f"Profiled {request.method} {request.path} ({duration * 1000:.1f} ms): {name}.prof")
+        return name
+
+
+def init_profiling(app):
+    app.config.setdefault("PROFILING_ENABLED", False)
+
+    @app.cli.group("profile")
+    def profile_cli():
+        """Request profiling."""
+
+    @profile_cli.command("sign")
+    @click.argument("path")
+    @click.option("--ttl", default=300, help="Seconds the header is valid")
+    def sign_command(path, ttl):
+        """Print an X-Profile header value for requests to PATH."""
+        if not app.config.get("PROFILING_SECRET"):
+            raise click.ClickException("PROFILING_SECRET is not set")
+        click.echo(f"{PROFILE_HEADER}: {sign(app.config['PROFILING_SECRET'], path, int(time.time()) + ttl)}")
+
+    if not app.config["PROFILING_ENABLED"]:
+        return
+
+    app.extensions["profiler"] = Profiler(
+        app.config.get("PROFILING_DIR", "profiles"),
+        sample_rate=app.config.get("PROFILING_SAMPLE_RATE", 0),
+        secret=app.config.get("PROFILING_SECRET"),
+        permission=app.config.get("PROFILING_PERMISSION", "profile:requests"),
+    )
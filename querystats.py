@@ -0,0 +1,95 @@
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# SQL query counter
+# Counts the statements and the time spent in the database per request and
+# flags statements that are repeated with different parameters (N+1 queries,
+# usually a lazy relationship loaded in a loop).
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        """
+        Statements executed at least threshold times in this request
+        """
+        return [(statement, n) for statement, n in self.statements.most_common() if n >= threshold]
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    stats = g.get("query_stats")
+    if stats is not None:
+        stats.record(statement, duration)
+
+
+def current_stats():
+    return g.get("query_stats")
+
+
+def init_querystats(app):
+    app.config.setdefault("QUERY_STATS_ENABLED", False)
+    app.config.setdefault("QUERY_STATS_HEADERS", False)
+    app.config.setdefault("QUERY_N_PLUS_ONE_THRESHOLD", 5)
+    app.config.setdefault("QUERY_BUDGETS", {})
+    app.config.setdefault("QUERY_BUDGET_ENFORCE", False)
+
+    if not app.config["QUERY_STATS_ENABLED"]:
+        return
+
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get("query_stats")
+        if stats is None:
+            return response
+
+        repeated = stats.repeated(app.config["QUERY_N_PLUS_ONE_THRESHOLD"])
+        for statement, n in repeated:
+            print(f"Possible N+1 query in {request.endpoint}: {n}x {' '.join(statement.split())[:200]}")
+
+        if app.config["QUERY_STATS_HEADERS"]:
+            response.headers["X-Query-Count"] = str(stats.count)
+            response.headers["X-Query-Time-ms"] = f"{stats.duration * 1000:.1f}"
+            if repeated:
+                response.headers["X-Query-Repeated"] = str(max(n for _, n in repeated))
+
+        budget = app.config["QUERY_BUDGETS"].get(request.endpoint)
+        if app.config["QUERY_BUDGET_ENFORCE"] and budget is not None and stats.count > budget:
+            raise QueryBudgetExceeded(
+                f"{request.endpoint} executed {stats.count} queries, budget is {budget}")
+        return response
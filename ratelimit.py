@@ -0,0 +1,197 @@
+import math
+import threading
+import time
+
+from flask import current_app, jsonify, request
+
+# Rate limiting and load shedding
+# Every authenticated request takes a token from a bucket keyed by the JWT
+# subject and the required permission. Budgets are set per endpoint (or per
+# permission) in RATELIMIT_BUDGETS as "<requests>/<second|minute|hour>".
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+
+
+class RateLimitError(Exception):
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_budget(budget):
+    """
+    Turns "60/minute" into (capacity, tokens per second)
+    """
+    amount, period = budget.split("/")
+    capacity = int(amount)
+    return capacity, capacity / PERIODS[period.strip()]
+
+
+#----------------------------------------------------------------------------#
+# Bucket stores
+#----------------------------------------------------------------------------#
+
+class MemoryRateLimitStore:
+    """
+    Token buckets in the memory of the worker process
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """
+        Takes one token, returns the seconds to wait (0 when allowed)
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+
+# Atomic token bucket in Redis, returns the seconds to wait (0 when allowed)
+REDIS_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisRateLimitStore:
+    """
+    Token buckets in Redis, shared by all workers.
+    Requires the optional 'redis' package.
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError("RATELIMIT_STORE 'redis' requires the redis package") from exc
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(REDIS_TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate):
+        return float(self._take(keys=[self.prefix + key], args=[capacity, rate, time.time()]))
+
+
+def create_ratelimit_store(config):
+    store = config.get("RATELIMIT_STORE", "memory")
+    if store == "memory":
+        return MemoryRateLimitStore()
+    if store == "redis":
+        return RedisRateLimitStore(config.get("RATELIMIT_REDIS_URL"))
+    raise ValueError(f"Unknown RATELIMIT_STORE: {store}")
+
+
+#----------------------------------------------------------------------------#
+# Checks used by auth.requires_auth
+#----------------------------------------------------------------------------#
+
+# Requests currently being handled by this worker
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+def open_feeds():
+    """
+    Open /events streams of this worker. They hold a thread but aren't in
+    _in_flight: Flask tears the request down before a streamed body is sent.
+    """
+    broker = current_app.extensions.get("events")
+    return broker.subscriber_count() if broker is not None else 0
+
+
+def shed_load():
+    """
+    Rejects the request before any work is done when the worker is overloaded
+    """
+    limit = current_app.config.get("RATELIMIT_MAX_IN_FLIGHT")
+    if limit and _in_flight + open_feeds() > limit:
+        raise RateLimitError(
+            {
+                "code": "overloaded",
+                "description": "Server is busy, please retry later"
+            }, 503, current_app.config.get("RATELIMIT_SHED_RETRY_AFTER", 1))
+
+
+def check_rate_limit(permission, payload):
+    """
+    Takes a token from the bucket of the token subject, permission and budget
+    """
+    store = current_app.extensions.get("ratelimit")
+    if store is None:
+        return
+
+    budgets = current_app.config.get("RATELIMIT_BUDGETS", {})
+    # One bucket per budget: endpoints sharing a permission only share a bucket
+    # when they also share the budget
+    if budgets.get(request.endpoint):
+        scope, budget = request.endpoint, budgets[request.endpoint]
+    elif budgets.get(permission):
+        scope, budget = "permission", budgets[permission]
+    else:
+        scope, budget = "default", current_app.config.get("RATELIMIT_DEFAULT")
+    if not budget:
+        return
+
+    capacity, rate = parse_budget(budget)
+    wait = store.take(f"{payload.get('sub')}:{permission}:{scope}", capacity, rate)
+    if wait > 0:
+        raise RateLimitError(
+            {
+                "code": "rate_limited",
+                "description": "Too many requests"
+            }, 429, math.ceil(wait))
+
+
+def init_ratelimit(app):
+    if not app.config.get("RATELIMIT_ENABLED"):
+        return
+
+    app.extensions["ratelimit"] = create_ratelimit_store(app.config)
+
+    @app.before_request
+    def count_request():
+        global _in_flight
+        with _in_flight_lock:
+            _in_flight += 1
+
+    @app.teardown_request
+    def uncount_request(exc):
+        global _in_flight
+        with _in_flight_lock:
+            _in_flight -= 1
+
+    @app.errorhandler(RateLimitError)
+    def rate_limited(e):
+        response = jsonify({
+            "success": False,
+            "error": e.status_code,
+            "description": e.error["description"],
+            "code": e.error["code"],
+        })
+        response.status_code = e.status_code
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
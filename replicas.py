@@ -0,0 +1,153 @@
+import itertools
+import threading
+import time
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from auth import BATCH_PAYLOAD
+
+# Read replicas
+# The read-only routes in REPLICA_ROUTES run their queries on one of the
+# DATABASE_REPLICA_URLS, chosen round-robin among the healthy ones. These are
+# not SQLALCHEMY_BINDS, so create_all and migrations never touch them. A background thread checks the
+# replicas; a replica which fails a check or a query is skipped until it
+# passes again. With no healthy replica the primary is used. A statement
+# which fails on a replica is run again on the primary, together with the
+# rest of its request.
+#
+# A client which wrote something gets a cookie and reads from the primary for
+# REPLICA_STICKY_SECONDS, so it sees its own writes despite replication lag.
+
+STICKY_COOKIE = "read_primary_until"
+
+
+def reads_from_primary():
+    """
+    Whether the client wrote recently and must read its own writes
+    """
+    return request.cookies.get(STICKY_COOKIE, 0, type=float) > time.time()
+
+
+class RoutingSession(Session):
+    """
+    Session which sends all statements of a replica routed request to its replica
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            engine = g.get("read_engine")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _execute_internal(self, *args, **kwargs):
+        # Every statement of the session goes through here (execute, scalars, get, Query)
+        try:
+            return super()._execute_internal(*args, **kwargs)
+        except DBAPIError as err_replica:
+            if not has_app_context() or g.get("read_engine") is None:
+                raise
+            # The request only reads, run the statement and the rest of the request on the primary
+            print(f"Replica read failed, retrying on the primary: {err_replica}")
+            g.read_engine = None
+            self.rollback()
+            return super()._execute_internal(*args, **kwargs)
+
+
+class ReplicaPool:
+    def __init__(self, engines, health_interval=10):
+        # bind key -> engine
+        self.engines = engines
+        self.health_interval = health_interval
+        self.healthy = set(engines)
+        self._counter = itertools.count()
+        self._checker = None
+        # The health thread and the error listener change healthy while requests choose
+        self._lock = threading.Lock()
+
+        for key, engine in engines.items():
+            event.listen(engine, "handle_error", self._on_error(key))
+
+    def _on_error(self, key):
+        def handle_error(context):
+            # Lost connection or database gone, stop routing to it until the next check passes
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                self.mark(key, False)
+        return handle_error
+
+    def mark(self, key, healthy):
+        with self._lock:
+            if healthy and key not in self.healthy:
+                print(f"Replica {key} is healthy again")
+                self.healthy.add(key)
+            elif not healthy and key in self.healthy:
+                print(f"Replica {key} is unavailable, reading from the other replicas or the primary")
+                self.healthy.discard(key)
+
+    def choose(self):
+        """
+        Next healthy replica engine round-robin, None to use the primary
+        """
+        with self._lock:
+            healthy = sorted(self.healthy)
+        if not healthy:
+            return None
+        return self.engines[healthy[next(self._counter) % len(healthy)]]
+
+    def check(self):
+        for key, engine in self.engines.items():
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                self.mark(key, True)
+            except DBAPIError as err_replica:
+                print(str(err_replica))
+                self.mark(key, False)
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(self.health_interval)
+                self.check()
+
+        self._checker = threading.Thread(target=run, name="replica-health", daemon=True)
+        self._checker.start()
+
+
+def init_replicas(app):
+    app.config.setdefault("REPLICA_ROUTES", [])
+    app.config.setdefault("REPLICA_STICKY_SECONDS", 5)
+    app.config.setdefault("REPLICA_HEALTH_INTERVAL", 10)
+
+    urls = app.config.get("DATABASE_REPLICA_URLS")
+    if not urls:
+        return
+    engines = {f"replica_{i}": create_engine(url, pool_pre_ping=True) for i, url in enumerate(urls)}
+
+    pool = ReplicaPool(engines, app.config["REPLICA_HEALTH_INTERVAL"])
+    pool.check()
+    pool.start()
+    app.extensions["replicas"] = pool
+    routes = set(app.config["REPLICA_ROUTES"])
+    sticky = app.config["REPLICA_STICKY_SECONDS"]
+
+    @app.before_request
+    def route_reads():
+        if request.endpoint not in routes or request.method not in ("GET", "HEAD"):
+            return
+        # A batch shares one session with its other requests, keep it on the primary
+        if request.environ.get(BATCH_PAYLOAD) is not None:
+            return
+        if reads_from_primary():
+            return
+        g.read_engine = pool.choose()
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+            until = time.time() + sticky
+            response.set_cookie(STICKY_COOKIE, f"{until:.3f}", max_age=int(sticky) + 1, httponly=True, samesite="Lax")
+        return response
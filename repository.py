@@ -0,0 +1,51 @@
+from sqlalchemy import bindparam, func, select
+
+from model import db, Movie, Actor, Cast
+
+# Lookups of the request handlers
+# Primary key lookups go through session.get, which returns a row already in
+# the identity map of the session without a query, as long as the request
+# still holds a reference to it (the identity map is weak). The other lookups
+# are statements built once with bound parameters: their compiled SQL comes
+# from the statement cache, instead of building a legacy Query and its cache
+# key on every call. See bench_repository.py for the per-call overhead.
+
+CAST_OF_ACTOR_IN_MOVIE = select(Cast) \
+    .where(Cast.mov_id == bindparam("mov_id"), Cast.act_id == bindparam("act_id")) \
+    .limit(1)
+CAST_ROLE = select(Cast) \
+    .where(Cast.mov_id == bindparam("mov_id"), Cast.act_id == bindparam("act_id"), Cast.cas_role == bindparam("cas_role")) \
+    .limit(1)
+MOVIE_CAST_COUNT = select(func.count(Cast.cas_id)).where(Cast.mov_id == bindparam("mov_id"))
+ACTOR_CAST_COUNT = select(func.count(Cast.cas_id)).where(Cast.act_id == bindparam("act_id"))
+
+
+def get_movie(mov_id):
+    return db.session.get(Movie, mov_id)
+
+
+def get_actor(act_id):
+    return db.session.get(Actor, act_id)
+
+
+def get_cast(cas_id):
+    return db.session.get(Cast, cas_id)
+
+
+def find_cast(mov_id, act_id):
+    """
+    First cast entry of the actor in the movie, None when there is none
+    """
+    return db.session.scalars(CAST_OF_ACTOR_IN_MOVIE, {"mov_id": mov_id, "act_id": act_id}).first()
+
+
+def find_cast_role(mov_id, act_id, cas_role):
+    return db.session.scalars(CAST_ROLE, {"mov_id": mov_id, "act_id": act_id, "cas_role": cas_role}).first()
+
+
+def count_movie_casts(mov_id):
+    return db.session.scalar(MOVIE_CAST_COUNT, {"mov_id": mov_id})
+
+
+def count_actor_casts(act_id):
+    return db.session.scalar(ACTOR_CAST_COUNT, {"act_id": act_id})
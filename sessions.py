@@ -0,0 +1,270 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+# Server-side sessions
+# The cookie only carries a signed session id, the session data itself
+# (the Auth0 token response) lives in one of the stores below.
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    Session dict which remembers whether it was changed during the request
+    """
+
+    def __init__(self, initial=None, sid=None, new=False, store=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.store = store
+
+    def regenerate(self):
+        """
+        Moves the session to a new id, call on login so an id planted in the
+        browser before (session fixation) doesn't get the user's token
+        """
+        if self.store is not None and not self.new:
+            self.store.delete(self.sid)
+        forget_pretty(self.sid)
+        self.sid = uuid.uuid4().hex
+        self.modified = True
+
+
+#----------------------------------------------------------------------------#
+# Session stores
+#----------------------------------------------------------------------------#
+
+class MemorySessionStore:
+    """
+    Keeps sessions in the memory of the worker process.
+    Only usable with a single worker (or for testing).
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.time():
+                del self._data[sid]
+                return None
+            return data
+
+    def set(self, sid, data, lifetime):
+        with self._lock:
+            self._data[sid] = (time.time() + lifetime, data)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+
+class SQLiteSessionStore:
+    """
+    Keeps sessions in a local SQLite file, shared by all workers on the host.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # The sessions hold access tokens, only this user may read the file
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " sid TEXT PRIMARY KEY,"
+                " expires REAL NOT NULL,"
+                " data TEXT NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        row = self._connect().execute(
+            "SELECT expires, data FROM sessions WHERE sid = ?", (sid,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[0] < time.time():
+            self.delete(sid)
+            return None
+        return json.loads(row[1])
+
+    def set(self, sid, data, lifetime):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, expires, data) VALUES (?, ?, ?)",
+                (sid, time.time() + lifetime, json.dumps(data)),
+            )
+            # Purge expired sessions once in a while
+            if int(time.time()) % 100 == 0:
+                conn.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class RedisSessionStore:
+    """
+    Keeps sessions in Redis, shared by all workers and dynos.
+    Requires the optional 'redis' package.
+    """
+
+    def __init__(self, url, prefix="session:"):
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError("SESSION_STORE 'redis' requires the redis package") from exc
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, sid):
+        raw = self.client.get(self.prefix + sid)
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    def set(self, sid, data, lifetime):
+        self.client.setex(self.prefix + sid, int(lifetime), json.dumps(data))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+def create_session_store(config):
+    """
+    Builds the session store selected by SESSION_STORE in the app config
+    """
+    store = config.get("SESSION_STORE", "sqlite")
+    if store == "memory":
+        return MemorySessionStore()
+    if store == "sqlite":
+        return SQLiteSessionStore(config.get("SESSION_SQLITE_PATH"))
+    if store == "redis":
+        return RedisSessionStore(config.get("SESSION_REDIS_URL"))
+    raise ValueError(f"Unknown SESSION_STORE: {store}")
+
+
+#----------------------------------------------------------------------------#
+# Session interface
+#----------------------------------------------------------------------------#
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface storing the session data in a session store.
+    The cookie holds nothing more than the signed session id.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="server-session")
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if app.secret_key and cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.get(sid)
+                if data is not None:
+                    return ServerSession(data, sid=sid, store=self.store)
+        return ServerSession(sid=uuid.uuid4().hex, new=True, store=self.store)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified and not self.should_set_cookie(app, session):
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.modified:
+            self.store.set(session.sid, dict(session), lifetime)
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid.encode()).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def init_sessions(app):
+    app.session_interface = ServerSessionInterface(create_session_store(app.config))
+
+
+#----------------------------------------------------------------------------#
+# Template context
+#----------------------------------------------------------------------------#
+
+# Pretty printed user info per session id, rendered once per worker. Kept
+# out of the session, so it isn't written to the store with every session.
+PRETTY_CACHE_SIZE = 1000
+_pretty_cache = OrderedDict()
+_pretty_lock = threading.Lock()
+
+
+def forget_pretty(sid):
+    with _pretty_lock:
+        _pretty_cache.pop(sid, None)
+
+
+def user_context(session):
+    """
+    Returns the template variables for the logged in user
+    """
+    user = session.get("user")
+    if user is None:
+        forget_pretty(session.sid)
+        return {"session": None, "pretty": json.dumps(None)}
+    with _pretty_lock:
+        pretty = _pretty_cache.get(session.sid)
+        if pretty is not None:
+            _pretty_cache.move_to_end(session.sid)
+    if pretty is None:
+        pretty = json.dumps(user, indent=4)
+        with _pretty_lock:
+            _pretty_cache[session.sid] = pretty
+            if len(_pretty_cache) > PRETTY_CACHE_SIZE:
+                _pretty_cache.popitem(last=False)
+    return {"session": user, "pretty": pretty}
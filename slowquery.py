@@ -0,0 +1,199 @@
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
+from collections import defaultdict
+
+import click
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Slow query log
+# Statements slower than SLOW_QUERY_THRESHOLD_MS are written to a JSON lines
+# log with their route and redacted parameters. The query plan is captured by
+# a background thread, so the request itself is not slowed down further.
+# `flask slow-queries` groups the log by statement fingerprint.
+
+
+def fingerprint(statement):
+    """
+    Normalizes a statement so executions differing only in values group together
+    """
+    normalized = statement.lower()
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", normalized)
+    normalized = re.sub(r"\b\d+(\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"%\(\w+\)s|%s|:\w+|\$\d+", "?", normalized)
+    normalized = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", normalized)
+    normalized = " ".join(normalized.split())
+    return normalized, hashlib.md5(normalized.encode()).hexdigest()[:12]
+
+
+def redact(parameters):
+    """
+    Keeps only the types of the bound parameters
+    """
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+# Statements which have a query plan (no DDL, pragmas, ...)
+EXPLAINABLE = {"select", "insert", "update", "delete", "with"}
+
+
+def explain_prefix(dialect, analyze):
+    if dialect == "postgresql":
+        return "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    if dialect == "sqlite":
+        return "EXPLAIN QUERY PLAN "
+    return None
+
+
+class SlowQueryLog:
+    def __init__(self, path, threshold, explain=True, analyze=False):
+        self.path = path
+        self.threshold = threshold
+        self.explain = explain
+        self.analyze = analyze
+        self._write_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=100)
+        self._worker = None
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("slow_query_start")
+        if not starts:
+            return
+        duration = time.perf_counter() - starts.pop()
+        if duration * 1000 < self.threshold:
+            return
+
+        normalized, digest = fingerprint(statement)
+        entry = {
+            "time": time.time(),
+            "duration_ms": round(duration * 1000, 1),
+            "route": request.endpoint if has_request_context() else threading.current_thread().name,
+            "method": request.method if has_request_context() else None,
+            "fingerprint": digest,
+            "statement": normalized,
+            "parameters": None if executemany else redact(parameters),
+        }
+
+        # Explain on another connection in the background, the parameters
+        # are only kept in memory for that and never written to the log
+        can_explain = self.explain and not executemany and explain_prefix(conn.dialect.name, False) is not None \
+            and normalized.split(" ", 1)[0] in EXPLAINABLE
+        if not can_explain:
+            self.write(entry)
+            return
+        try:
+            self._queue.put_nowait((conn.engine, statement, parameters, entry))
+        except queue.Full:
+            self.write(entry)
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._explain_loop, name="slow-query-explain", daemon=True)
+            self._worker.start()
+
+    def _explain_loop(self):
+        while True:
+            engine, statement, parameters, entry = self._queue.get()
+            try:
+                entry["plan"] = self.capture_plan(engine, statement, parameters)
+            except Exception as err_explain:
+                entry["plan_error"] = str(err_explain)
+            self.write(entry)
+
+    def capture_plan(self, engine, statement, parameters):
+        dialect = engine.dialect.name
+        # ANALYZE runs the statement, only do that for reads
+        analyze = self.analyze and statement.lstrip().lower().startswith("select")
+        with engine.connect() as conn:
+            # Don't time (and log) the explain itself
+            conn.execution_options(slow_query_skip=True)
+            result = conn.exec_driver_sql(explain_prefix(dialect, analyze) + statement, parameters)
+            plan = [" ".join(str(value) for value in row) for row in result]
+            conn.rollback()
+        return plan
+
+    def write(self, entry):
+        print(f"Slow query ({entry['duration_ms']} ms) in {entry['route']}: {entry['statement'][:200]}")
+        if not self.path:
+            return
+        with self._write_lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+def report(path, limit):
+    """
+    Groups the slow query log by fingerprint, slowest total time first
+    """
+    groups = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "routes": set(), "statement": None, "plan": None})
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            group = groups[entry["fingerprint"]]
+            group["count"] += 1
+            group["total_ms"] += entry["duration_ms"]
+            group["max_ms"] = max(group["max_ms"], entry["duration_ms"])
+            group["routes"].add(str(entry.get("route")))
+            group["statement"] = entry["statement"]
+            if entry.get("plan"):
+                group["plan"] = entry["plan"]
+
+    ranked = sorted(groups.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:limit]
+    for digest, group in ranked:
+        click.echo(f"{digest}  {group['count']}x  total {group['total_ms']:.1f} ms  "
+                   f"mean {group['total_ms'] / group['count']:.1f} ms  max {group['max_ms']:.1f} ms")
+        click.echo(f"  routes: {', '.join(sorted(group['routes']))}")
+        click.echo(f"  {group['statement']}")
+        for line in group["plan"] or []:
+            click.echo(f"    {line}")
+        click.echo()
+
+
+def init_slowquery(app):
+    app.config.setdefault("SLOW_QUERY_ENABLED", False)
+
+    @app.cli.command("slow-queries")
+    @click.option("--log", "path", default=None, help="Slow query log, defaults to SLOW_QUERY_LOG")
+    @click.option("--limit", default=20, help="Number of fingerprints to show")
+    def slow_queries(path, limit):
+        """Report slow statements grouped by fingerprint."""
+        report(path or app.config["SLOW_QUERY_LOG"], limit)
+
+    if not app.config["SLOW_QUERY_ENABLED"]:
+        return
+
+    log = SlowQueryLog(
+        app.config.get("SLOW_QUERY_LOG"),
+        app.config.get("SLOW_QUERY_THRESHOLD_MS", 200),
+        explain=app.config.get("SLOW_QUERY_EXPLAIN", True),
+        analyze=app.config.get("SLOW_QUERY_EXPLAIN_ANALYZE", False),
+    )
+    app.extensions["slow_query_log"] = log
+
+    def before(conn, *args):
+        if not conn.get_execution_options().get("slow_query_skip"):
+            log.before_cursor_execute(conn, *args)
+
+    def after(conn, *args):
+        if not conn.get_execution_options().get("slow_query_skip"):
+            log.after_cursor_execute(conn, *args)
+
+    event.listen(Engine, "before_cursor_execute", before)
+    event.listen(Engine, "after_cursor_execute", after)
@@ -0,0 +1,381 @@
+import bisect
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from model import db, Movie, Actor, Cast
+from sync import counter_value, COUNTER
+
+# Catalog snapshot
+# Read-only binary copy of the movies, actors and casts tables in columnar
+# form. It is written atomically to disk and memory-mapped by every worker,
+# so all workers share one physical copy through the page cache.
+#
+# Every worker rebuilds the file after its own writes. The header carries the
+# catalog version (the sync counter) the rows were read at, and a rebuild
+# doesn't replace a file of a newer version, so a slow rebuild can't put an
+# older catalog back. The check and the replace hold a lock on <path>.lock.
+#
+# Layout (int32 arrays in native byte order, strings as index into the
+# string table, -1 for NULL):
+#   header (with the catalog version)
+#   movies:  mov_id, mov_title, mov_release, mov_language   (sorted by mov_id)
+#   actors:  act_id, act_firstname, act_lastname, act_language, act_gender   (sorted by act_id)
+#   casts:   mov_id, act_id, cas_role   (sorted by mov_id, act_id)
+#   cast_by_actor: positions in casts sorted by act_id
+#   strings: offsets (n_strings + 1), utf-8 blob
+
+MAGIC = b"CASTSNAP"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sIIIIIQ")
+NULL = -1
+# mov_release may be NULL as well, use a value outside the check constraint
+NULL_INT = -2147483648
+
+MovieRow = namedtuple("MovieRow", "mov_id mov_title mov_release mov_language")
+ActorRow = namedtuple("ActorRow", "act_id act_firstname act_lastname act_language act_gender")
+
+
+#----------------------------------------------------------------------------#
+# Writer
+#----------------------------------------------------------------------------#
+
+class StringTable:
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return NULL
+        if value not in self.index:
+            self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return self.index[value]
+
+    def pack(self):
+        blob = bytearray()
+        offsets = array("i", [0])
+        for value in self.strings:
+            blob += value.encode()
+            offsets.append(len(blob))
+        return offsets, bytes(blob)
+
+
+def write_snapshot(path):
+    """
+    Writes a snapshot of the catalog tables, replacing the old file atomically
+    unless it holds a newer catalog version. Returns whether it was replaced.
+    """
+    strings = StringTable()
+
+    # Read before the rows, so the rows are at least as new as the version
+    generation = counter_value(COUNTER)
+
+    movies = db.session.query(Movie.mov_id, Movie.mov_title, Movie.mov_release, Movie.mov_language) \
+        .order_by(Movie.mov_id).all()
+    actors = db.session.query(Actor.act_id, Actor.act_firstname, Actor.act_lastname, Actor.act_language, Actor.act_gender) \
+        .order_by(Actor.act_id).all()
+    casts = db.session.query(Cast.mov_id, Cast.act_id, Cast.cas_role) \
+        .order_by(Cast.mov_id, Cast.act_id, Cast.cas_id).all()
+
+    columns = [
+        array("i", [m.mov_id for m in movies]),
+        array("i", [strings.add(m.mov_title) for m in movies]),
+        array("i", [NULL_INT if m.mov_release is None else int(m.mov_release) for m in movies]),
+        array("i", [strings.add(m.mov_language) for m in movies]),
+        array("i", [a.act_id for a in actors]),
+        array("i", [strings.add(a.act_firstname) for a in actors]),
+        array("i", [strings.add(a.act_lastname) for a in actors]),
+        array("i", [strings.add(a.act_language) for a in actors]),
+        array("i", [strings.add(a.act_gender) for a in actors]),
+        array("i", [c.mov_id for c in casts]),
+        array("i", [c.act_id for c in casts]),
+        array("i", [strings.add(c.cas_role) for c in casts]),
+        array("i", sorted(range(len(casts)), key=lambda i: (casts[i].act_id, i))),
+    ]
+    offsets, blob = strings.pack()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(movies), len(actors), len(casts), len(strings.strings), generation))
+            for column in columns:
+                column.tofile(f)
+            offsets.tofile(f)
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if snapshot_generation(path) > generation:
+                os.unlink(tmp_path)
+                return False
+            os.replace(tmp_path, path)
+        return True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def snapshot_generation(path):
+    """
+    Catalog version of the snapshot file, -1 when there is no valid file
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+    except FileNotFoundError:
+        return -1
+    if len(header) < HEADER.size:
+        return -1
+    magic, version, _, _, _, _, generation = HEADER.unpack(header)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return -1
+    return generation
+
+
+#----------------------------------------------------------------------------#
+# Reader
+#----------------------------------------------------------------------------#
+
+class CatalogSnapshot:
+    """
+    One memory-mapped version of the snapshot file
+    """
+
+    def __init__(self, f):
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_movies, n_actors, n_casts, n_strings, self.generation = HEADER.unpack_from(self._mm)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a catalog snapshot")
+
+        view = memoryview(self._mm)
+        position = HEADER.size
+
+        def column(length):
+            nonlocal position
+            size = length * 4
+            col = view[position:position + size].cast("i")
+            position += size
+            return col
+
+        self.mov_id, self.mov_title, self.mov_release, self.mov_language = [column(n_movies) for _ in range(4)]
+        self.act_id, self.act_firstname, self.act_lastname, self.act_language, self.act_gender = [column(n_actors) for _ in range(5)]
+        self.cas_mov_id, self.cas_act_id, self.cas_role = [column(n_casts) for _ in range(3)]
+        self.cast_by_actor = column(n_casts)
+        self._offsets = column(n_strings + 1)
+        self._blob = view[position:]
+
+    def string(self, index):
+        if index == NULL:
+            return None
+        return str(self._blob[self._offsets[index]:self._offsets[index + 1]], "utf-8")
+
+    def _movie(self, i):
+        release = self.mov_release[i]
+        return MovieRow(self.mov_id[i], self.string(self.mov_title[i]),
+                        None if release == NULL_INT else release, self.string(self.mov_language[i]))
+
+    def _actor(self, i):
+        return ActorRow(self.act_id[i], self.string(self.act_firstname[i]), self.string(self.act_lastname[i]),
+                        self.string(self.act_language[i]), self.string(self.act_gender[i]))
+
+    def movies(self):
+        return [self._movie(i) for i in range(len(self.mov_id))]
+
+    def actors(self):
+        return [self._actor(i) for i in range(len(self.act_id))]
+
+    def movie(self, mov_id):
+        i = bisect.bisect_left(self.mov_id, mov_id)
+        if i < len(self.mov_id) and self.mov_id[i] == mov_id:
+            return self._movie(i)
+        return None
+
+    def actor(self, act_id):
+        i = bisect.bisect_left(self.act_id, act_id)
+        if i < len(self.act_id) and self.act_id[i] == act_id:
+            return self._actor(i)
+        return None
+
+    def movie_cast(self, mov_id):
+        """
+        Cast entries of a movie as (actor, cas_role)
+        """
+        start = bisect.bisect_left(self.cas_mov_id, mov_id)
+        end = bisect.bisect_right(self.cas_mov_id, mov_id, lo=start)
+        return [(self.actor(self.cas_act_id[i]), self.string(self.cas_role[i])) for i in range(start, end)]
+
+    def actor_casts(self, act_id):
+        """
+        Cast entries of an actor as (movie, cas_role)
+        """
+        positions = self.cast_by_actor
+        start = bisect.bisect_left(positions, act_id, key=lambda i: self.cas_act_id[i])
+        end = bisect.bisect_right(positions, act_id, lo=start, key=lambda i: self.cas_act_id[i])
+        return [(self.movie(self.cas_mov_id[positions[p]]), self.string(self.cas_role[positions[p]])) for p in range(start, end)]
+
+
+class SnapshotReader:
+    """
+    Hands out the current snapshot, remapping the file when it was replaced
+    """
+
+    def __init__(self, path, ready):
+        self.path = path
+        # Set once this process rebuilt the file, an older file may be stale
+        self.ready = ready
+        self._snapshot = None
+        self._file_id = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self.ready.is_set():
+            return None
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if file_id != self._file_id:
+            with self._lock:
+                if file_id != self._file_id:
+                    try:
+                        with open(self.path, "rb") as f:
+                            self._snapshot = CatalogSnapshot(f)
+                    except (OSError, ValueError) as err_snapshot:
+                        print(str(err_snapshot))
+                        return None
+                    self._file_id = file_id
+        return self._snapshot
+
+
+class SnapshotWriter:
+    """
+    Rebuilds the snapshot in the background shortly after catalog changes
+    """
+
+    def __init__(self, app, path, delay):
+        self.app = app
+        self.path = path
+        self.delay = delay
+        self.rebuilt = threading.Event()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def schedule(self):
+        # Several writes in a row only cause one rebuild
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.rebuild)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def rebuild(self):
+        with self.app.app_context():
+            try:
+                if not write_snapshot(self.path):
+                    print("Snapshot rebuild skipped, the file holds a newer catalog")
+                self.rebuilt.set()
+            except Exception as err_snapshot:
+                print("Snapshot rebuild failed:", str(err_snapshot))
+            finally:
+                db.session.remove()
+
+
+#----------------------------------------------------------------------------#
+# Change tracking
+#----------------------------------------------------------------------------#
+
+CATALOG_TABLES = {"movies", "actors", "casts"}
+
+
+def mark_catalog_changed(session):
+    session.info["catalog_changed"] = True
+
+
+def track_flush(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Movie, Actor, Cast)):
+            mark_catalog_changed(session)
+            return
+
+
+def track_execute(orm_execute_state):
+    # Bulk inserts, updates and deletes don't go through the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None and table.name in CATALOG_TABLES:
+            mark_catalog_changed(orm_execute_state.session)
+
+
+def after_rollback(session):
+    session.info.pop("catalog_changed", None)
+
+
+def after_commit(session):
+    if session.info.pop("catalog_changed", False):
+        # The writer of the app the session belongs to
+        writer = current_app.extensions.get("snapshot_writer")
+        if writer is not None:
+            writer.schedule()
+
+
+def init_snapshot(app):
+    app.config.setdefault("SNAPSHOT_ENABLED", False)
+    if not app.config["SNAPSHOT_ENABLED"]:
+        return
+
+    path = app.config.get("SNAPSHOT_PATH") or default_snapshot_path(app.config["SQLALCHEMY_DATABASE_URI"])
+    writer = SnapshotWriter(app, path, app.config.get("SNAPSHOT_REBUILD_DELAY", 0.2))
+    app.extensions["snapshot"] = SnapshotReader(path, writer.rebuilt)
+    app.extensions["snapshot_writer"] = writer
+
+    if not event.contains(Session, "before_flush", track_flush):
+        event.listen(Session, "before_flush", track_flush)
+        event.listen(Session, "do_orm_execute", track_execute)
+        event.listen(Session, "after_rollback", after_rollback)
+        event.listen(Session, "after_commit", after_commit)
+
+    # A file left by an earlier deploy, a crash or changes made outside the
+    # app may be stale: rebuild it when the process starts serving, reads go
+    # to the database until then
+    started = threading.Event()
+
+    @app.before_request
+    def rebuild_on_start():
+        if not started.is_set():
+            started.set()
+            writer.schedule()
+
+
+def default_snapshot_path(database_uri):
+    """
+    Snapshot file of a database, so apps on other databases don't share it
+    """
+    name = hashlib.sha1((database_uri or "").encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f"casting_catalog-{name}.snap")
+
+
+def current_snapshot():
+    """
+    The snapshot to serve reads from, None when disabled or not written yet
+    """
+    reader = current_app.extensions.get("snapshot")
+    if reader is None:
+        return None
+    return reader.get()
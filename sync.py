@@ -0,0 +1,257 @@
+import heapq
+import time
+
+import click
+from flask import jsonify, request
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.orm import Session
+
+from auth import requires_auth
+from model import db, Movie, Actor, Cast, Tombstone, SyncCounter
+
+# Delta sync
+# Every insert, update and delete of a movie, actor or cast entry takes the
+# next number of one catalog wide counter as its version; deletes leave a
+# tombstone with their version. GET /sync?since=<cursor> returns the changes
+# after the cursor ordered by version, read through the version indexes.
+#
+# The counter row stays locked until the writing transaction commits, so
+# versions become visible in order and a cursor never skips a change. When
+# the counter is not past the cursor there is nothing to sync, which is one
+# primary key lookup. since=0 is a full export of the live rows and always
+# works; its cursors stay marked as an export (x<version>) until they pass the
+# purged tombstones, so the export isn't cut off with a 410 halfway.
+
+COUNTER = "catalog"
+# Highest version of the purged tombstones, older cursors can't be served
+PURGED = "purged"
+# Cursor of a full export which is still behind the purged tombstones
+EXPORT_PREFIX = "x"
+
+# Model -> (table name in the feed, id column, version column, updated column, exported columns)
+VERSIONED = {
+    Movie: ("movie", Movie.mov_id, Movie.mov_version, Movie.mov_updated,
+            (Movie.mov_id, Movie.mov_title, Movie.mov_release, Movie.mov_language)),
+    Actor: ("actor", Actor.act_id, Actor.act_version, Actor.act_updated,
+            (Actor.act_id, Actor.act_firstname, Actor.act_lastname, Actor.act_language, Actor.act_gender)),
+    Cast: ("cast", Cast.cas_id, Cast.cas_version, Cast.cas_updated,
+           (Cast.cas_id, Cast.mov_id, Cast.act_id, Cast.cas_role)),
+}
+VERSIONED_TABLES = {model.__tablename__: model for model in VERSIONED}
+
+
+def counter_value(name):
+    value = db.session.query(SyncCounter.syn_value).filter(SyncCounter.syn_name == name).scalar()
+    return value or 0
+
+
+def next_versions(connection, n):
+    """
+    Reserves n versions, returns the first one
+    """
+    counter = SyncCounter.__table__
+    value = connection.execute(
+        counter.update()
+        .where(counter.c.syn_name == COUNTER)
+        .values(syn_value=counter.c.syn_value + n)
+        .returning(counter.c.syn_value)
+    ).scalar()
+    if value is None:
+        connection.execute(counter.insert().values(syn_name=COUNTER, syn_value=n))
+        value = n
+    return value - n + 1
+
+
+def stamp_rows(model, rows):
+    """
+    Sets the version of rows (dicts) written with a bulk insert, which skips the flush
+    """
+    if not rows:
+        return
+    _, _, version_column, updated_column, _ = VERSIONED[model]
+    first = next_versions(db.session.connection(), len(rows))
+    now = time.time()
+    for i, row in enumerate(rows):
+        row[version_column.key] = first + i
+        row[updated_column.key] = now
+
+
+def parse_cursor(value):
+    """
+    (version, exporting) of a cursor, exporting while a full export from since=0 continues
+    """
+    if value.startswith(EXPORT_PREFIX):
+        return int(value[len(EXPORT_PREFIX):]), True
+    since = int(value)
+    return since, since == 0
+
+
+def format_cursor(version, exporting):
+    return f"{EXPORT_PREFIX}{version}" if exporting else str(version)
+
+
+#----------------------------------------------------------------------------#
+# Change tracking
+#----------------------------------------------------------------------------#
+
+def stamp_flush(session, flush_context, instances):
+    changed = [obj for obj in session.new if type(obj) in VERSIONED]
+    changed += [obj for obj in session.dirty
+                if type(obj) in VERSIONED and session.is_modified(obj, include_collections=False)]
+    deleted = [obj for obj in session.deleted if type(obj) in VERSIONED]
+    if not changed and not deleted:
+        return
+
+    version = next_versions(session.connection(), len(changed) + len(deleted))
+    now = time.time()
+    for obj in changed:
+        _, _, version_column, updated_column, _ = VERSIONED[type(obj)]
+        setattr(obj, version_column.key, version)
+        setattr(obj, updated_column.key, now)
+        version += 1
+    for obj in deleted:
+        table, id_column, _, _, _ = VERSIONED[type(obj)]
+        session.add(Tombstone(tom_table=table, tom_row_id=getattr(obj, id_column.key),
+                              tom_version=version, tom_deleted=now))
+        version += 1
+
+
+def tombstone_bulk_delete(orm_execute_state):
+    # query(...).delete() doesn't go through the flush, look up the ids it deletes
+    if not orm_execute_state.is_delete:
+        return
+    statement = orm_execute_state.statement
+    table = getattr(statement, "table", None)
+    model = VERSIONED_TABLES.get(getattr(table, "name", None))
+    if model is None:
+        return
+
+    table_name, id_column, _, _, _ = VERSIONED[model]
+    query = select(id_column)
+    if statement.whereclause is not None:
+        query = query.where(statement.whereclause)
+    connection = orm_execute_state.session.connection()
+    ids = connection.execute(query).scalars().all()
+    if not ids:
+        return
+    version = next_versions(connection, len(ids))
+    now = time.time()
+    connection.execute(insert(Tombstone.__table__), [
+        {"tom_table": table_name, "tom_row_id": row_id, "tom_version": version + i, "tom_deleted": now}
+        for i, row_id in enumerate(ids)
+    ])
+
+
+#----------------------------------------------------------------------------#
+# Feed
+#----------------------------------------------------------------------------#
+
+def changes_since(since, limit):
+    """
+    Changes after version since, at most limit, ordered by version
+    """
+    sources = []
+    for model, (table, _, version_column, updated_column, columns) in VERSIONED.items():
+        rows = db.session.query(version_column, updated_column, *columns) \
+            .filter(version_column > since) \
+            .order_by(version_column) \
+            .limit(limit).all()
+        sources.append([
+            {"table": table, "version": row[0], "updated": row[1],
+             "data": {column.key: value for column, value in zip(columns, row[2:])}}
+            for row in rows
+        ])
+
+    tombstones = db.session.query(Tombstone.tom_version, Tombstone.tom_deleted, Tombstone.tom_table, Tombstone.tom_row_id) \
+        .filter(Tombstone.tom_version > since) \
+        .order_by(Tombstone.tom_version) \
+        .limit(limit).all()
+    sources.append([
+        {"table": table, "version": version, "updated": deleted, "deleted": True, "id": row_id}
+        for version, deleted, table, row_id in tombstones
+    ])
+
+    merged = heapq.merge(*sources, key=lambda change: change["version"])
+    return [change for _, change in zip(range(limit), merged)]
+
+
+def backfill_versions():
+    """
+    Gives the rows written before versioning existed a version
+    """
+    updated = 0
+    for model, (_, id_column, version_column, updated_column, _) in VERSIONED.items():
+        ids = [row_id for (row_id,) in db.session.query(id_column).filter(version_column.is_(None)).order_by(id_column)]
+        if not ids:
+            continue
+        version = next_versions(db.session.connection(), len(ids))
+        now = time.time()
+        db.session.execute(update(model), [
+            {id_column.key: row_id, version_column.key: version + i, updated_column.key: now}
+            for i, row_id in enumerate(ids)
+        ])
+        updated += len(ids)
+    db.session.commit()
+    return updated
+
+
+def init_sync(app):
+    app.config.setdefault("SYNC_PAGE_SIZE", 500)
+    app.config.setdefault("SYNC_TOMBSTONE_RETENTION", 30 * 24 * 3600)
+
+    if not event.contains(Session, "before_flush", stamp_flush):
+        event.listen(Session, "before_flush", stamp_flush)
+        event.listen(Session, "do_orm_execute", tombstone_bulk_delete)
+
+    # Changes after a cursor, for replicas of the catalog
+    @app.route('/sync', methods=['GET'])
+    @requires_auth('read:movies')
+    def sync(payload):
+        try:
+            since, exporting = parse_cursor(request.args.get('since', '0'))
+            limit = min(int(request.args.get('limit', app.config["SYNC_PAGE_SIZE"])), app.config["SYNC_PAGE_SIZE"])
+        except ValueError:
+            since = limit = -1
+        if since < 0 or limit < 1:
+            return jsonify({"success": False, "error": "Invalid cursor or limit"}), 400
+
+        # Nothing changed since the cursor
+        if counter_value(COUNTER) <= since:
+            return jsonify({"success": True, "changes": [], "cursor": str(since), "more": False})
+
+        # Deletes after this cursor may have been purged, the replica has to start over.
+        # A full export only has the live rows, the purged deletes don't concern it.
+        purged = counter_value(PURGED)
+        if not exporting and since < purged:
+            return jsonify({"success": False, "error": "Cursor expired, sync again from since=0"}), 410
+
+        changes = changes_since(since, limit)
+        cursor = changes[-1]["version"] if changes else since
+        return jsonify({"success": True, "changes": changes, "cursor": format_cursor(cursor, exporting and cursor < purged),
+                        "more": len(changes) == limit})
+
+    @app.cli.group("sync")
+    def sync_cli():
+        """Versions and tombstones of the delta sync."""
+
+    @sync_cli.command("backfill")
+    def backfill():
+        """Give existing rows a version."""
+        click.echo(f"Updated {backfill_versions()} rows")
+
+    @sync_cli.command("purge")
+    def purge():
+        """Delete tombstones older than SYNC_TOMBSTONE_RETENTION."""
+        cutoff = time.time() - app.config["SYNC_TOMBSTONE_RETENTION"]
+        purged = db.session.query(db.func.max(Tombstone.tom_version)).filter(Tombstone.tom_deleted < cutoff).scalar()
+        if purged is None:
+            click.echo("Deleted 0 tombstones")
+            return
+        deleted = db.session.query(Tombstone).filter(Tombstone.tom_version <= purged).delete(synchronize_session=False)
+        counter = db.session.get(SyncCounter, PURGED)
+        if counter is None:
+            db.session.add(SyncCounter(syn_name=PURGED, syn_value=purged))
+        else:
+            counter.syn_value = max(counter.syn_value, purged)
+        db.session.commit()
+        click.echo(f"Deleted {deleted} tombstones")
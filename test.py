@@ -2,6 +2,11 @@ import os
 import unittest
 import json
 import subprocess
+import tempfile
+import threading
+import time
+import gzip
+from unittest import mock
 
 from os import environ as env
 from dotenv import load_dotenv
@@ -15,7 +20,19 @@ os.environ["FLASK_DEBUG"] = "true"
 
 from authlib.integrations.requests_client import OAuth2Session
 from app import create_app, db
-from model import Movie, Actor, Cast
+from model import Movie, Actor, Cast, SyncCounter
+from sync import PURGED, COUNTER
+from replicas import STICKY_COOKIE
+from auth import requires_auth, BATCH_PAYLOAD
+from config import TestingConfig
+from jobs import run_inline, job, enqueue, claim_next_job, run_job, requeue_stale_jobs
+from model import Job
+from sqlalchemy.exc import OperationalError
+from snapshot import current_snapshot, write_snapshot, snapshot_generation
+from events import matches
+import compression
+from itsdangerous import Signer
+from sqlalchemy import create_engine, text
 
 class CastingAgency_TestCase(unittest.TestCase):
 
@@ -109,6 +126,65 @@ class CastingAgency_TestCase(unittest.TestCase):
             self.fail("Response does not contain 'success' key")
         self.assertEqual(data["mov_title"], self.movie_data["mov_title"])
 
+    def test_create_actor_duplicate_rejected(self):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        res = self.client().post('/actor/create', json=self.actor_data, headers=headers)
+        self.assertEqual(res.status_code, 201)
+
+        # Same name with other case, accents and spacing
+        duplicate = dict(self.actor_data, act_firstname="bryce  dallás", act_lastname="HOWARD")
+        res = self.client().post('/actor/create', json=duplicate, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data["duplicate"]["act_lastname"], self.actor_data["act_lastname"])
+
+    def test_create_actor_near_duplicate_warns(self):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        self.client().post('/actor/create', json=self.actor_data, headers=headers)
+
+        typo = dict(self.actor_data, act_lastname="Howerd")
+        res = self.client().post('/actor/create', json=typo, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual([d["match"] for d in data["possible_duplicates"]], ["near"])
+
+    def test_create_movie_duplicate_merged(self):
+        self.app.config["DEDUPE_EXACT_POLICY"] = "merge"
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        res = self.client().post('/movie/create', json=dict(self.movie_data, mov_language=None), headers=headers)
+        mov_id = json.loads(res.data)["data"]["mov_id"]
+
+        res = self.client().post('/movie/create', json=self.movie_data, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["merged"])
+        self.assertEqual(data["data"]["mov_id"], mov_id)
+        # The missing language is filled in from the second post
+        self.assertEqual(data["data"]["mov_language"], self.movie_data["mov_language"])
+
+    def test_create_movie_long_title_key(self):
+        # Casefolding makes the key longer than the title
+        movie_data = dict(self.movie_data, mov_title="ß" * 30)
+        res = self.client().post('/movie/create', json=movie_data, headers={
+            "Authorization": f"Bearer {self.access_token}"})
+        self.assertEqual(res.status_code, 201)
+        with self.app.app_context():
+            self.assertLessEqual(len(Movie.query.one().mov_title_key), 30)
+
+    def test_bulk_create_movies_skips_duplicates(self):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        self.client().post('/movie/create', json=self.movie_data, headers=headers)
+
+        other = dict(self.movie_data, mov_title="Jurassic Park")
+        res = self.client().post('/movie/create', json=[self.movie_data, other, other], headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data["data"]["created"], 1)
+        # Duplicate of the table and of an earlier row of the batch
+        self.assertEqual([e["index"] for e in data["data"]["errors"]], [0, 2])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 2)
+
     def test_create_cast(self):
         actor = Actor(**self.actor_data)
         movie = Movie(**self.movie_data)
@@ -196,6 +272,279 @@ class CastingAgency_TestCase(unittest.TestCase):
             self.assertTrue(data["cast_list"])
             self.assertEqual(data["cast_list"][0]["title"], self.movie_data["mov_title"])
 
+    def test_movie_cast_query_budget(self):
+        with self.app.app_context():
+            movie = Movie(**self.movie_data)
+            db.session.add(movie)
+            db.session.commit()
+
+            # Several cast entries, so per-entry queries would show up in the count
+            for i in range(6):
+                actor = Actor(**self.actor_data)
+                db.session.add(actor)
+                db.session.commit()
+                db.session.add(Cast(mov_id=movie.mov_id, act_id=actor.act_id, cas_role=f"Role {i}"))
+            db.session.commit()
+            mov_id = movie.mov_id
+
+        res = self.client().get(f'/movie/{mov_id}/cast', headers={
+            "Authorization": f"Bearer {self.access_token}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["cast_list"]), 6)
+        self.assertLessEqual(int(res.headers["X-Query-Count"]), self.app.config["QUERY_BUDGETS"]["get_movie_cast"])
+        self.assertNotIn("X-Query-Repeated", res.headers)
+
+    def test_movie_cast_fields(self):
+        with self.app.app_context():
+            movie = Movie(**self.movie_data)
+            actor = Actor(**self.actor_data)
+            db.session.add_all([movie, actor])
+            db.session.commit()
+            db.session.add(Cast(mov_id=movie.mov_id, act_id=actor.act_id, cas_role=self.cast_data["cas_role"]))
+            db.session.commit()
+            mov_id = movie.mov_id
+
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        res = self.client().get(f'/movie/{mov_id}/cast?fields=act_id,act_gender&include=movie', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data["cast_list"][0]), {"act_id", "act_gender"})
+        self.assertEqual(data["movie"]["mov_release"], self.movie_data["mov_release"])
+
+        res = self.client().get(f'/movie/{mov_id}/cast?fields=act_salary', headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_sync_since(self):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        # Take the cursor after a first write, so it isn't 0
+        with self.app.app_context():
+            db.session.add(Movie(**self.movie_data))
+            db.session.commit()
+        res = self.client().get('/sync?since=0', headers=headers)
+        cursor = json.loads(res.data)["cursor"]
+        self.assertGreater(int(cursor), 0)
+
+        with self.app.app_context():
+            movie = Movie(**self.movie_data)
+            db.session.add(movie)
+            db.session.commit()
+            mov_id = movie.mov_id
+            db.session.delete(movie)
+            db.session.commit()
+
+        res = self.client().get(f'/sync?since={cursor}', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(c["table"], c.get("deleted", False)) for c in data["changes"]],
+                         [("movie", True)])
+        self.assertEqual(data["changes"][0]["id"], mov_id)
+
+        res = self.client().get(f'/sync?since={data["cursor"]}', headers=headers)
+        self.assertEqual(json.loads(res.data)["changes"], [])
+
+        # After a purge old cursors expire, but a new replica can still start from 0
+        with self.app.app_context():
+            db.session.add(Movie(**self.movie_data))
+            db.session.add(SyncCounter(syn_name=PURGED, syn_value=int(data["cursor"])))
+            db.session.commit()
+        res = self.client().get(f'/sync?since={cursor}', headers=headers)
+        self.assertEqual(res.status_code, 410)
+        res = self.client().get('/sync?since=0', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("movie", [c["table"] for c in json.loads(res.data)["changes"]])
+
+    def test_batch_transaction(self):
+        res = self.client().post('/batch', json={
+            "transaction": True,
+            "requests": [
+                {"method": "POST", "path": "/movie/create", "body": self.movie_data},
+                {"method": "POST", "path": "/cast/create", "body": self.cast_data},
+            ]}, headers={"Authorization": f"Bearer {self.access_token}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data["committed"])
+        self.assertEqual([r["status"] for r in data["responses"]], [201, 400])
+
+        # The movie created by the first request is rolled back
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 0)
+
+    def test_rate_limit_per_budget(self):
+        config = type("Config", (TestingConfig,), {
+            "RATELIMIT_ENABLED": True,
+            "RATELIMIT_DEFAULT": "100/minute",
+            "RATELIMIT_BUDGETS": {"get_movie_cast": "2/minute"},
+        })
+        client = create_app(config).test_client()
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        for _ in range(2):
+            self.assertNotEqual(client.get('/movie/1/cast', headers=headers).status_code, 429)
+        res = client.get('/movie/1/cast', headers=headers)
+        self.assertEqual(res.status_code, 429)
+        self.assertGreater(int(res.headers["Retry-After"]), 0)
+
+        # Same permission (read:cast), but its own budget and bucket
+        self.assertEqual(client.get('/cast', headers=headers).status_code, 200)
+
+    def test_bulk_create_job(self):
+        config = type("Config", (TestingConfig,), {"JOBS_ENABLED": True})
+        app = create_app(config)
+        client = app.test_client()
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        res = client.post('/movie/create', json=[self.movie_data, "not a movie"], headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+        res = client.post('/movie/create', json=[self.movie_data], headers=headers)
+        self.assertEqual(res.status_code, 202)
+        location = res.headers["Location"]
+        self.assertTrue(location.endswith(f'/jobs/{json.loads(res.data)["job_id"]}'))
+        self.assertEqual(json.loads(client.get(location, headers=headers).data)["job"]["status"], "queued")
+
+        with app.app_context():
+            run_job(app, claim_next_job())
+        data = json.loads(client.get(location, headers=headers).data)
+        self.assertEqual(data["job"]["status"], "done")
+        self.assertEqual(data["job"]["result"]["created"], 1)
+
+        # Only the token subject which started the job sees it
+        with app.app_context():
+            db.session.query(Job).update({"job_owner": "someone else"})
+            db.session.commit()
+        self.assertEqual(client.get(location, headers=headers).status_code, 404)
+
+    def coalescing_app(self):
+        """
+        App coalescing a slow test endpoint, the first call waits for self.release
+        """
+        config = type("Config", (TestingConfig,), {"COALESCE_ENABLED": True, "COALESCE_ROUTES": ["slow"]})
+        app = create_app(config)
+        self.calls = []
+        self.release = threading.Event()
+        self.fail_first = False
+
+        @requires_auth('read:movies')
+        def slow(payload):
+            self.calls.append(1)
+            if len(self.calls) == 1:
+                self.release.wait(5)
+                if self.fail_first:
+                    raise RuntimeError("leader failed")
+            return {"call": len(self.calls)}
+
+        app.add_url_rule('/test/slow', 'slow', slow)
+        return app, app.extensions["coalescer"]
+
+    def get_in_threads(self, app, n, responses, path='/test/slow'):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        def get():
+            try:
+                responses.append(app.test_client().get(path, headers=headers))
+            except RuntimeError as err_leader:
+                responses.append(err_leader)
+
+        threads = [threading.Thread(target=get) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_coalescing_one_leader(self):
+        app, coalescer = self.coalescing_app()
+        responses = []
+        threads = self.get_in_threads(app, 1, responses)
+        self.assertTrue(wait_for(lambda: len(self.calls) == 1))
+        threads += self.get_in_threads(app, 3, responses)
+        # The followers are waiting for the leader
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual([json.loads(res.data) for res in responses], [{"call": 1}] * 4)
+        self.assertEqual(sorted(res.headers.get("X-Coalesced", "0") for res in responses), ["0", "1", "1", "1"])
+        self.assertEqual(coalescer.report(), {"stats": {"leaders": 1, "coalesced": 3}, "in_flight": 0})
+
+    def test_coalescing_timeout(self):
+        app, coalescer = self.coalescing_app()
+        coalescer.timeout = 0.1
+        responses = []
+        threads = self.get_in_threads(app, 1, responses)
+        self.assertTrue(wait_for(lambda: len(self.calls) == 1))
+        # Runs on its own while the leader is still busy
+        follower = app.test_client().get('/test/slow', headers={"Authorization": f"Bearer {self.access_token}"})
+        self.assertEqual(json.loads(follower.data), {"call": 2})
+        self.assertNotIn("X-Coalesced", follower.headers)
+        self.release.set()
+        threads[0].join()
+        self.assertEqual(coalescer.report()["stats"], {"leaders": 1, "timeouts": 1})
+
+    def test_coalescing_failed_leader(self):
+        app, coalescer = self.coalescing_app()
+        self.fail_first = True
+        responses = []
+        threads = self.get_in_threads(app, 1, responses)
+        self.assertTrue(wait_for(lambda: len(self.calls) == 1))
+        threads += self.get_in_threads(app, 1, responses)
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        # The follower ran the endpoint again instead of sharing the failure
+        follower = [res for res in responses if not isinstance(res, RuntimeError)]
+        self.assertEqual(len(follower), 1)
+        self.assertEqual(follower[0].status_code, 200)
+        self.assertNotIn("X-Coalesced", follower[0].headers)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(coalescer.report()["stats"], {"leaders": 1, "failed_leaders": 1})
+
+    def test_no_coalescing_for_batch_or_sticky(self):
+        app, coalescer = self.coalescing_app()
+        payload = {"sub": "test", "permissions": ["read:movies"]}
+        with app.test_request_context('/test/slow'):
+            self.assertIsNotNone(coalescer.key(payload))
+        with app.test_request_context('/test/slow', environ_overrides={BATCH_PAYLOAD: payload}):
+            self.assertIsNone(coalescer.key(payload))
+        with app.test_request_context('/test/slow', headers={"Cookie": f"{STICKY_COOKIE}={time.time() + 60}"}):
+            self.assertIsNone(coalescer.key(payload))
+
+        # A sticky request runs the endpoint itself while an identical one is busy
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        clients = [app.test_client(), app.test_client()]
+        for client in clients:
+            client.set_cookie("localhost", STICKY_COOKIE, str(time.time() + 60))
+        busy = threading.Thread(target=lambda: clients[0].get('/test/slow', headers=headers))
+        busy.start()
+        self.assertTrue(wait_for(lambda: len(self.calls) == 1))
+        res = clients[1].get('/test/slow', headers=headers)
+        self.release.set()
+        busy.join()
+        self.assertEqual(json.loads(res.data), {"call": 2})
+        self.assertEqual(coalescer.report()["stats"], {})
+
+    def test_sampled_profile_id_needs_permission(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = type("Config", (TestingConfig,), {
+            "PROFILING_ENABLED": True, "PROFILING_SAMPLE_RATE": 1, "PROFILING_DIR": directory.name,
+            "PROFILING_PERMISSION": "profile:test-only",
+        })
+        app = create_app(config)
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        # Profiled, but the token doesn't learn about it
+        res = app.test_client().get('/movie/1/cast', headers=headers)
+        self.assertNotIn("X-Profile-Id", res.headers)
+        self.assertEqual(len([name for name in os.listdir(directory.name) if name.endswith(".prof")]), 1)
+
+        app.extensions["profiler"].permission = "read:cast"
+        res = app.test_client().get('/movie/1/cast', headers=headers)
+        self.assertTrue(os.path.exists(os.path.join(directory.name, res.headers["X-Profile-Id"] + ".prof")))
+
     def test_delete_actor(self):
         with self.app.app_context():
             actor = Actor(**self.actor_data)
@@ -234,6 +583,413 @@ class CastingAgency_TestCase(unittest.TestCase):
                 expected_status_code = 404  # Replace with the appropriate status code
                 self.assertEqual(res.status_code, expected_status_code)
 
+class ReplicaTestingConfig(TestingConfig):
+    DATABASE_REPLICA_URLS = []
+    REPLICA_HEALTH_INTERVAL = 3600
+    # A fallback to the primary runs the failed statement twice
+    QUERY_BUDGET_ENFORCE = False
+
+
+class Replica_TestCase(unittest.TestCase):
+    """
+    Replica routing with two SQLite files, no Auth0 token needed
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        primary_url = f"sqlite:///{os.path.join(self.directory.name, 'primary.db')}"
+        replica_url = f"sqlite:///{os.path.join(self.directory.name, 'replica.db')}"
+
+        # Same rows with different titles, to tell where a read went
+        for url, title in ((primary_url, "Primary title"), (replica_url, "Replica title")):
+            engine = create_engine(url)
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.execute(Movie.__table__.insert(), {"mov_id": 1, "mov_title": title, "mov_release": 2022})
+                conn.execute(Actor.__table__.insert(), {"act_id": 1, "act_firstname": "Bryce Dallas", "act_lastname": "Howard"})
+                conn.execute(Cast.__table__.insert(), {"mov_id": 1, "act_id": 1, "cas_role": "Claire Dearing"})
+            engine.dispose()
+
+        config = type("Config", (ReplicaTestingConfig,), {
+            "SQLALCHEMY_DATABASE_URI": primary_url,
+            "DATABASE_REPLICA_URLS": [replica_url],
+        })
+        self.app = create_app(config)
+        self.client = self.app.test_client()
+        self.replica_engine = self.app.extensions["replicas"].engines["replica_0"]
+
+    def tearDown(self):
+        self.replica_engine.dispose()
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.directory.cleanup()
+
+    def portfolio_title(self):
+        res = self.client.get('/actor/1/movies')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        return data["cast_list"][0]["title"]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.portfolio_title(), "Replica title")
+
+    def test_sticky_cookie_reads_from_primary(self):
+        self.client.set_cookie("localhost", STICKY_COOKIE, str(time.time() + 60))
+        self.assertEqual(self.portfolio_title(), "Primary title")
+
+    def test_failed_replica_falls_back_to_primary(self):
+        with self.replica_engine.begin() as conn:
+            conn.execute(text("DROP TABLE casts"))
+        # The request which hits the error is answered from the primary
+        self.assertEqual(self.portfolio_title(), "Primary title")
+        self.assertEqual(self.app.extensions["replicas"].healthy, set())
+        self.assertEqual(self.portfolio_title(), "Primary title")
+
+
+class Shedding_TestCase(unittest.TestCase):
+    """
+    Load shedding happens before the token is checked, no Auth0 token needed
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = type("Config", (TestingConfig,), {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(self.directory.name, 'catalog.db')}",
+            "RATELIMIT_ENABLED": True,
+            "RATELIMIT_MAX_IN_FLIGHT": 1,
+            "EVENTS_ENABLED": True,
+            "EVENTS_SQLITE_PATH": os.path.join(self.directory.name, "events.db"),
+        })
+        self.app = create_app(config)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        # The event poller stops once the feed is gone, let it finish before removing its log
+        for thread in threading.enumerate():
+            if thread.name == "event-poller":
+                thread.join(2)
+        self.directory.cleanup()
+
+    def test_open_feeds_count_as_in_flight(self):
+        # Only this request in flight: not shed, rejected for the missing token
+        self.assertEqual(self.client.get('/movie/1/cast').status_code, 401)
+
+        broker = self.app.extensions["events"]
+        feed = broker.subscribe()
+        try:
+            res = self.client.get('/movie/1/cast')
+            self.assertEqual(res.status_code, 503)
+            self.assertIn("Retry-After", res.headers)
+        finally:
+            broker.unsubscribe(feed)
+
+
+# Jobs for Jobs_TestCase
+flaky_calls = []
+
+
+@job("test_flaky")
+def flaky_job(progress):
+    flaky_calls.append(1)
+    if len(flaky_calls) == 1:
+        raise OperationalError("UPDATE movies", {}, Exception("database is locked"))
+    return {"calls": len(flaky_calls)}
+
+
+@job("test_broken")
+def broken_job(progress):
+    raise ValueError("bad parameters")
+
+
+class Compression_TestCase(unittest.TestCase):
+    """
+    Response compression on a few routes of the test itself
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = type("Config", (TestingConfig,), {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(self.directory.name, 'catalog.db')}",
+            "COMPRESS_ENABLED": True,
+            "COMPRESS_MIN_SIZE": 500,
+        })
+        self.app = create_app(config)
+        self.body = {"movies": [f"Movie title {i}" for i in range(100)]}
+        self.app.add_url_rule('/test/large', 'large', lambda: self.body)
+        self.app.add_url_rule('/test/small', 'small', lambda: {"success": True})
+        self.app.add_url_rule('/test/encoded', 'encoded', lambda: (
+            gzip.compress(json.dumps(self.body).encode()), {"Content-Encoding": "gzip", "Content-Type": "application/json"}))
+        self.app.add_url_rule('/test/stream', 'stream', lambda: self.app.response_class(
+            (f"line {i}\n" for i in range(200)), mimetype="text/html"))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_gzip(self):
+        res = self.client.get('/test/large', headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        self.assertEqual(json.loads(gzip.decompress(res.data)), self.body)
+
+    @unittest.skipIf(compression.brotli is None, "brotli not installed")
+    def test_brotli_preferred(self):
+        res = self.client.get('/test/large', headers={"Accept-Encoding": "gzip, deflate, br"})
+        self.assertEqual(res.headers["Content-Encoding"], "br")
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        self.assertEqual(json.loads(compression.brotli.decompress(res.data)), self.body)
+
+        # Unless the client prefers gzip
+        res = self.client.get('/test/large', headers={"Accept-Encoding": "gzip;q=1.0, br;q=0.5"})
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+
+    def test_not_compressed(self):
+        # Without Accept-Encoding
+        res = self.client.get('/test/large')
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertEqual(json.loads(res.data), self.body)
+
+        # Below COMPRESS_MIN_SIZE
+        res = self.client.get('/test/small', headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertEqual(json.loads(res.data), {"success": True})
+
+        # Encoded by the view already
+        res = self.client.get('/test/encoded', headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(res.data)), self.body)
+
+    def test_streamed_response(self):
+        res = self.client.get('/test/stream', headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", res.headers)
+        self.assertEqual(gzip.decompress(res.data).decode(), "".join(f"line {i}\n" for i in range(200)))
+
+        if compression.brotli is not None:
+            res = self.client.get('/test/stream', headers={"Accept-Encoding": "br"})
+            self.assertEqual(res.headers["Content-Encoding"], "br")
+            self.assertEqual(compression.brotli.decompress(res.data).decode(), "".join(f"line {i}\n" for i in range(200)))
+
+
+class Sessions_TestCase(unittest.TestCase):
+    """
+    Server-side sessions, Auth0 is replaced by a fixed token response
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = type("Config", (TestingConfig,), {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(self.directory.name, 'catalog.db')}",
+        })
+        self.app = create_app(config)
+        with self.app.app_context():
+            db.create_all()
+        self.store = self.app.session_interface.store
+        self.signer = Signer(self.app.secret_key, salt="server-session")
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.directory.cleanup()
+
+    def session_cookie(self, response):
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        name, value = cookie.split("=", 1)
+        self.assertEqual(name, self.app.config["SESSION_COOKIE_NAME"])
+        return value
+
+    def test_login_regenerates_session(self):
+        client = self.app.test_client()
+        # A session id planted before the login
+        with client.session_transaction() as planted:
+            planted["next"] = "/"
+        old_sid = planted.sid
+        self.assertIsNotNone(self.store.get(old_sid))
+
+        token = {"access_token": "secret-access-token", "userinfo": {"name": "Test user"}}
+        auth0 = self.app.extensions["authlib.integrations.flask_client"].auth0
+        with mock.patch.object(auth0, "authorize_access_token", return_value=token):
+            res = client.get('/callback')
+
+        # The cookie carries nothing more than the signed id of a new session
+        cookie = self.session_cookie(res)
+        sid = self.signer.unsign(cookie).decode()
+        self.assertNotEqual(sid, old_sid)
+        self.assertEqual(cookie, self.signer.sign(sid.encode()).decode())
+        self.assertNotIn("secret-access-token", res.headers["Set-Cookie"])
+        self.assertIsNone(self.store.get(old_sid))
+        self.assertEqual(self.store.get(sid), {"user": token})
+
+        # The pretty printed user info isn't written to the session
+        res = client.get('/')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b"Test user", res.data)
+        self.assertEqual(self.store.get(sid), {"user": token})
+
+
+class Events_TestCase(unittest.TestCase):
+    """
+    Filters of the change feed
+    """
+
+    def test_cascading_deletes_reach_filtered_feeds(self):
+        cast_created = {"type": "cast.created", "mov_id": 1, "act_id": 2}
+        self.assertTrue(matches(cast_created, {1}, set()))
+        self.assertFalse(matches(cast_created, {3}, {4}))
+        # The cast entries of the movie are gone from the portfolio pages as well
+        self.assertTrue(matches({"type": "movie.deleted", "mov_id": 1, "act_id": None}, set(), {2}))
+        self.assertTrue(matches({"type": "actor.deleted", "mov_id": None, "act_id": 2}, {1}, set()))
+
+
+class Jobs_TestCase(unittest.TestCase):
+    """
+    Job queue without workers, the tests claim and run the jobs themselves
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = type("Config", (TestingConfig,), {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(self.directory.name, 'catalog.db')}",
+        })
+        self.app = create_app(config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        flaky_calls.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.ctx.pop()
+        self.directory.cleanup()
+
+    def claim_and_run(self):
+        queued_job = claim_next_job()
+        self.assertIsNotNone(queued_job)
+        run_job(self.app, queued_job)
+        db.session.expire_all()
+
+    def test_transient_failure_retried(self):
+        job_id = enqueue("test_flaky")
+        self.claim_and_run()
+        queued_job = db.session.get(Job, job_id)
+        self.assertEqual(queued_job.job_status, 'queued')
+        self.assertGreater(queued_job.job_run_at, time.time())
+        self.assertNotIn("Traceback", queued_job.job_error)
+
+        # Due again after the backoff
+        queued_job.job_run_at = time.time()
+        db.session.commit()
+        self.claim_and_run()
+        queued_job = db.session.get(Job, job_id)
+        self.assertEqual(queued_job.job_status, 'done')
+        self.assertEqual(queued_job.job_attempts, 2)
+        self.assertIsNone(queued_job.job_error)
+
+    def test_permanent_failure_not_retried(self):
+        job_id = enqueue("test_broken")
+        self.claim_and_run()
+        queued_job = db.session.get(Job, job_id)
+        self.assertEqual(queued_job.job_status, 'failed')
+        self.assertEqual(queued_job.job_attempts, 1)
+        self.assertEqual(queued_job.job_error, "ValueError: bad parameters")
+
+    def test_lost_worker_requeued(self):
+        job_id = enqueue("test_broken")
+        claim_next_job()
+        db.session.get(Job, job_id).job_claimed = time.time() - 1000
+        db.session.commit()
+        requeue_stale_jobs(600)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Job, job_id).job_status, 'queued')
+
+    def test_bulk_job_rows_not_objects(self):
+        result = run_inline("bulk_create_movies", movies=["Jurassic World Dominion", {"mov_title": "Jurassic Park", "mov_release": 1993}])
+        self.assertEqual(result["created"], 1)
+        self.assertEqual(result["errors"], [{"index": 0, "error": "Not an object"}])
+
+    def test_bulk_job_merges_duplicates(self):
+        self.app.config["DEDUPE_EXACT_POLICY"] = "merge"
+        db.session.add(Movie(mov_title="Jurassic Park", mov_release=1993))
+        db.session.commit()
+        result = run_inline("bulk_create_movies", movies=[
+            {"mov_title": "Jurassic Park", "mov_release": 1993, "mov_language": "EN"},
+            {"mov_title": "Jurassic World", "mov_release": 1993},
+            {"mov_title": "Jurassic World", "mov_release": 1993, "mov_language": "NL"},
+        ])
+        self.assertEqual(result["created"], 1)
+        self.assertEqual(result["errors"], [{"index": 0, "error": "merged"}, {"index": 2, "error": "merged"}])
+        db.session.expire_all()
+        # Into the existing row and into the earlier row of the batch
+        self.assertEqual({m.mov_title: m.mov_language for m in Movie.query}, {"Jurassic Park": "EN", "Jurassic World": "NL"})
+
+
+def wait_for(condition, timeout=5):
+    # Background work (snapshot rebuilds, job workers) finishes shortly after the request
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class Snapshot_TestCase(unittest.TestCase):
+    """
+    Catalog snapshot rebuilds, no Auth0 token needed
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = type("Config", (TestingConfig,), {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(self.directory.name, 'catalog.db')}",
+            "SNAPSHOT_ENABLED": True,
+            "SNAPSHOT_PATH": os.path.join(self.directory.name, "catalog.snap"),
+            "SNAPSHOT_REBUILD_DELAY": 0,
+            "QUERY_BUDGET_ENFORCE": False,
+        })
+        self.app = create_app(config)
+        with self.app.app_context():
+            db.create_all()
+        # The first request starts the startup rebuild
+        self.app.test_client().get('/')
+        self.assertTrue(wait_for(lambda: self.snapshot() is not None))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.directory.cleanup()
+
+    def snapshot(self):
+        with self.app.test_request_context('/'):
+            return current_snapshot()
+
+    def test_bulk_created_movies_in_snapshot(self):
+        movies = [{"mov_title": f"Bulk movie {i}", "mov_release": 2000 + i} for i in range(3)]
+        with self.app.app_context():
+            result = run_inline("bulk_create_movies", movies=movies)
+        self.assertEqual(result["created"], 3)
+        self.assertTrue(wait_for(lambda: len(self.snapshot().movies()) == 3))
+
+    def test_older_rebuild_not_replacing_newer(self):
+        path = self.app.config["SNAPSHOT_PATH"]
+        with self.app.app_context():
+            db.session.add(Movie(mov_title="Jurassic Park", mov_release=1993))
+            db.session.commit()
+            self.assertTrue(wait_for(lambda: snapshot_generation(path) == 1))
+
+            # A rebuild which read the catalog before that write
+            db.session.get(SyncCounter, COUNTER).syn_value = 0
+            db.session.commit()
+            self.assertFalse(write_snapshot(path))
+        self.assertEqual(snapshot_generation(path), 1)
+        self.assertEqual([m.mov_title for m in self.snapshot().movies()], ["Jurassic Park"])
+
+
 if __name__ == "__main__":
     os.environ["FLASK_ENV"] = "testing"
     unittest.main()
\ No newline at end of file